@@ -0,0 +1,67 @@
+#!/usr/bin/python
+# This class handles the udp beat clock shared by all beat-based sessions.
+
+import gevent
+from gevent import socket
+
+
+class BeatClock:
+
+    def __init__(self, host, port):
+        """
+        This is the constructor for a BeatClock, which listens for beats on one udp socket and
+        calls the callback of every subscribed session for each beat. The socket is opened by the
+        first subscription and read cooperatively, so waiting for a beat does not block the server.
+        If it can not be opened, beat-based sessions get no beats until the clock is stopped.
+        """
+        self.host = host
+        self.port = port
+        # sid -> function called with the beat
+        self.subscribers = {}
+        self.sock = None
+        self.greenlet = None
+        # the socket could not be opened, later subscriptions do not try again
+        self.failed = False
+
+    def subscribe(self, sid, callback):
+        self.subscribers[sid] = callback
+        if self.greenlet is None and not self.failed:
+            self.start()
+
+    def unsubscribe(self, sid):
+        self.subscribers.pop(sid, None)
+
+    def start(self):
+        sock = None
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind((self.host, self.port))
+        except OSError as e:
+            print('ERROR: could not listen for beats on {}:{}'.format(self.host, self.port))
+            print(e)
+            if sock is not None:
+                sock.close()
+            self.failed = True
+            return
+        self.sock = sock
+        self.greenlet = gevent.spawn(self._listen)
+
+    def stop(self):
+        self.failed = False
+        if self.greenlet is not None:
+            self.greenlet.kill()
+            self.greenlet = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _listen(self):
+        while True:
+            data = self.sock.recv(2)
+            # a session may unsubscribe while the beat is handed out
+            for sid, callback in list(self.subscribers.items()):
+                try:
+                    callback(data)
+                except Exception as e:
+                    print('ERROR: beat for ' + str(sid) + ' failed')
+                    print(e)
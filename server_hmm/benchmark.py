@@ -0,0 +1,228 @@
+#!/usr/bin/python
+# This class handles the benchmarks of pretraining, training, sampling and the live handler.
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from corpus_cache import corpus_cache
+from hmm_handler import HMMHandler
+from note_tracker import NoteTracker, read_performance
+from parser import Parser
+
+SEED = 0
+CORPORA = ('midi/', 'piano/', 'jazz_midi/')
+LAYOUTS = ('note-time', 'time-note', 'joint', 'velocity-joint')
+NOTE_TYPES = ('midikeys', 'semitones', 'intervals')
+# the live training window and melody length of test.json
+WINDOW_SIZE = 15
+NR_SAMPLES = 10
+# the training limits of the server, without the time budget so every run does the same iterations
+TRAIN_ITERATIONS = 100
+TRAIN_TOLERANCE = 1e-2
+PERFORMANCE = 'piano/07_Argpeggien_mit_Pedal.mid'
+BASELINE = 'benchmark_baseline.json'
+
+
+def seed():
+    random.seed(SEED)
+    np.random.seed(SEED)
+
+
+def matrix_sizes(hmm):
+    params = hmm.get_parameters()
+    return {
+        'n_states': len(params['states']),
+        'n_observations': len(params['observations']),
+        'bytes': int(sum(array.nbytes for name, array in params.items() if isinstance(array, np.ndarray)))
+    }
+
+
+def corpus_so_pairs(parser, directory, n=None):
+    so_pairs = []
+    for events in corpus_cache.get(directory):
+        so_pairs.extend(parser.find_so_pairs(*parser._get_file_events(events)))
+        if n is not None and len(so_pairs) >= n:
+            return so_pairs[:n]
+    return so_pairs
+
+
+def pretrain_case(directory):
+    def setup():
+        # decoding is cached per process, so the runs measure parsing and counting
+        corpus_cache.get(directory)
+
+        def run():
+            parser = Parser(directory, pretrain=False)
+            parser.pretty_parse_gen()
+            return parser.my_hmm
+        return run
+    return setup
+
+
+def train_case(layout, note_type, diy):
+    def setup():
+        window = corpus_so_pairs(Parser('piano/', layout=layout, note_type=note_type, pretrain=False), 'piano/',
+                                 WINDOW_SIZE)
+
+        def run():
+            hmm = Parser('piano/', layout=layout, note_type=note_type, pretrain=False).my_hmm
+            hmm.set_fit_limits(TRAIN_ITERATIONS, TRAIN_TOLERANCE)
+            hmm.train(window, diy, 50, False)
+            return hmm
+        return run
+    return setup
+
+
+def sample_case(layout, note_type):
+    def setup():
+        parser = Parser('piano/', layout=layout, note_type=note_type, pretrain=False)
+        parser.my_hmm.train(corpus_so_pairs(parser, 'piano/'), True)
+        hmm = parser.my_hmm
+
+        def run():
+            for _ in range(100):
+                hmm.get_sample_so_pairs(NR_SAMPLES)
+            return hmm
+        return run
+    return setup
+
+
+def handler_case(layout):
+    def setup():
+        performance = read_performance(PERFORMANCE)
+        # pretrains into the model store once, the runs load it like a new session does
+        HMMHandler(files='midi/', layout=layout)
+
+        def run():
+            handler = HMMHandler(files='midi/', layout=layout, n_iter=TRAIN_ITERATIONS, tol=TRAIN_TOLERANCE)
+            tracker = NoteTracker()
+            for event_time, is_down, pitch, velocity in performance:
+                if is_down:
+                    rest = tracker.key_down(pitch, event_time, velocity)
+                    if rest is not None:
+                        handler.call(handler.parser.rest, rest)
+                else:
+                    note = tracker.key_up(pitch, event_time)
+                    if note is not None:
+                        handler.call(pitch, *note)
+            return handler.hmm
+        return run
+    return setup
+
+
+def get_cases(corpora=CORPORA):
+    cases = []
+    for directory in corpora:
+        cases.append(('pretrain/' + directory.strip('/'), pretrain_case(directory)))
+    for layout in LAYOUTS:
+        for note_type in NOTE_TYPES:
+            for diy in (True, False):
+                cases.append(('train/{}/{}/{}'.format(layout, note_type, 'diy' if diy else 'normal'),
+                              train_case(layout, note_type, diy)))
+    for layout in LAYOUTS:
+        for note_type in NOTE_TYPES:
+            cases.append(('sample/{}/{}'.format(layout, note_type), sample_case(layout, note_type)))
+    for layout in LAYOUTS:
+        cases.append(('handler/' + layout, handler_case(layout)))
+    return cases
+
+
+def measure(setup, repeats):
+    """
+    Runs a case repeats times from the same seed and once more with tracemalloc for the peak memory.
+    Returns the minimum and median seconds, the peak memory and the matrix sizes of the hmm it returns.
+    """
+    run = setup()
+    times = []
+    for _ in range(repeats):
+        seed()
+        start = time.perf_counter()
+        hmm = run()
+        times.append(time.perf_counter() - start)
+    seed()
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        'min': min(times),
+        'median': statistics.median(times),
+        'repeats': repeats,
+        'peak_memory': peak,
+        'sizes': matrix_sizes(hmm)
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the names of the cases which are slower or use more memory than the baseline by more than tolerance.
+    """
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        if result['median'] > old['median'] * (1 + tolerance) or \
+                result['peak_memory'] > old['peak_memory'] * (1 + tolerance):
+            regressions.append(name)
+    return regressions
+
+
+def main(argv):
+    arguments = argparse.ArgumentParser(description='Benchmarks the pretraining, training and sampling hot paths.')
+    arguments.add_argument('--baseline', default=BASELINE, help='json file of the results to compare with')
+    arguments.add_argument('--save', action='store_true', help='write the results as the new baseline')
+    arguments.add_argument('--repeats', type=int, default=5)
+    arguments.add_argument('--tolerance', type=float, default=0.25,
+                           help='slowdown or memory growth counted as a regression')
+    arguments.add_argument('--filter', default='', help='only run the cases whose name contains this')
+    arguments.add_argument('--quick', action='store_true', help='skip pretraining on the jazz corpus')
+    options = arguments.parse_args(argv)
+    corpora = CORPORA[:-1] if options.quick else CORPORA
+    baseline = {}
+    if os.path.exists(options.baseline):
+        with open(options.baseline) as file:
+            baseline = json.load(file)['results']
+    results = {}
+    print('{:<40} {:>10} {:>10} {:>10} {:>9} {:>8}'.format('case', 'median ms', 'min ms', 'peak KiB', 'sizes',
+                                                         'vs base'))
+    for name, setup in get_cases(corpora):
+        if options.filter not in name:
+            continue
+        result = results[name] = measure(setup, options.repeats)
+        old = baseline.get(name)
+        ratio = '{:.2f}x'.format(result['median'] / old['median']) if old else '-'
+        print('{:<40} {:>10.2f} {:>10.2f} {:>10.0f} {:>9} {:>8}'.format(
+            name, result['median'] * 1000, result['min'] * 1000, result['peak_memory'] / 1024,
+            '{}x{}'.format(result['sizes']['n_states'], result['sizes']['n_observations']), ratio))
+    regressions = compare(results, baseline, options.tolerance)
+    for name in regressions:
+        print('REGRESSION: ' + name)
+    if options.save:
+        with open(options.baseline, 'w') as file:
+            json.dump({
+                'meta': {
+                    'python': platform.python_version(),
+                    'numpy': np.__version__,
+                    'machine': platform.machine(),
+                    'cpus': os.cpu_count(),
+                    'seed': SEED,
+                    'time': time.time()
+                },
+                'results': results
+            }, file, indent=1, sort_keys=True)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    # python benchmark.py [--quick] [--filter train/] [--save]
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+# This class handles the index of the saved hmms.
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import model_io
+
+
+class ModelCatalogue:
+
+    def __init__(self, path):
+        """
+        This is the constructor for a ModelCatalogue, which keeps the name, save time, config, size
+        and corpus of every saved hmm in a sqlite table. Saving a model adds a row, so listing
+        the models does not depend on the number of files in the save directory.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS models ('
+                                    'name TEXT PRIMARY KEY, saved_at REAL, layout TEXT, config TEXT, '
+                                    'size INTEGER, corpus TEXT)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS models_saved_at ON models (saved_at)')
+
+    def add(self, name, config, size, corpus=None, saved_at=None):
+        """
+        Adds a saved hmm or replaces the row of one with the same name.
+        """
+        saved_at = time.time() if saved_at is None else saved_at
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO models VALUES (?, ?, ?, ?, ?, ?)',
+                                    (name, saved_at, config.get('layout'), json.dumps(config), size, corpus))
+
+    def remove(self, name):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM models WHERE name = ?', (name,))
+
+    def query(self, offset=0, limit=50, search=None, layout=None):
+        """
+        Returns the total number of saved hmms matching the filters and one page of them, newest first.
+        search matches a part of the name, layout the layout of the config.
+        """
+        conditions = []
+        args = []
+        if search:
+            conditions.append("name LIKE ? ESCAPE '\\'")
+            args.append('%' + search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+        if layout:
+            conditions.append('layout = ?')
+            args.append(layout)
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+        with self.lock:
+            total = self.connection.execute('SELECT COUNT(*) FROM models' + where, args).fetchone()[0]
+            rows = self.connection.execute('SELECT name, saved_at, config, size, corpus FROM models' + where +
+                                           ' ORDER BY saved_at DESC, name LIMIT ? OFFSET ?',
+                                           args + [max(0, int(limit)), max(0, int(offset))]).fetchall()
+        models = [{'name': name, 'saved_at': saved_at, 'config': json.loads(config), 'size': size, 'corpus': corpus}
+                  for name, saved_at, config, size, corpus in rows]
+        return total, models
+
+    def names(self, limit=50):
+        return [model['name'] for model in self.query(limit=limit)[1]]
+
+    def sync(self, directory):
+        """
+        Adds the saved hmms of a directory which are missing in the table and removes the rows
+        of deleted files. This reads the whole directory, it is meant to run once at start up.
+        """
+        with self.lock:
+            known = {name for (name,) in self.connection.execute('SELECT name FROM models')}
+        found = set()
+        for filename in os.listdir(directory):
+            if not filename.endswith(model_io.EXTENSION):
+                continue
+            name = filename[:-len(model_io.EXTENSION)]
+            found.add(name)
+            if name in known:
+                continue
+            path = os.path.join(directory, filename)
+            try:
+                header = model_io.load_header(path)
+            except (OSError, ValueError):
+                print('ERROR: ' + path + ' is not a saved hmm')
+                continue
+            stat = os.stat(path)
+            self.add(name, header['config'], stat.st_size, header.get('corpus'), stat.st_mtime)
+        for name in known - found:
+            self.remove(name)
@@ -0,0 +1,145 @@
+#!/usr/bin/python
+# This class handles the conversion of hmms saved as pickles by older versions into saved hmm files.
+
+import argparse
+import inspect
+import os
+import pickle
+import sys
+
+import model_io
+from catalogue import ModelCatalogue
+from hmm_handler import HMMHandler
+
+PICKLE_PATH = 'pickle/'
+# the directory and catalogue of server.py
+SAVE_PATH = 'saved/'
+# the classes and functions a pickled handler is made of, (module, name) -> whether the conversion reads it
+ALLOWED_GLOBALS = {
+    ('hmm_handler', 'HMMHandler'): True,
+    ('parser', 'Parser'): True,
+    ('my_hmm', 'HiddenMarkovModel'): True,
+    ('my_hmm', 'SOPair'): True,
+    ('numpy', 'ndarray'): True,
+    ('numpy', 'dtype'): True,
+    ('numpy.core.multiarray', '_reconstruct'): True,
+    ('numpy._core.multiarray', '_reconstruct'): True,
+    ('numpy.core.multiarray', 'scalar'): True,
+    ('numpy._core.multiarray', 'scalar'): True,
+    ('numpy.core.numeric', '_frombuffer'): True,
+    ('numpy._core.numeric', '_frombuffer'): True,
+    ('copyreg', '_reconstructor'): True,
+    # the bytes of arrays in pickles of protocol 2 and lower
+    ('_codecs', 'encode'): True,
+    ('builtins', 'object'): True,
+    ('builtins', 'set'): True,
+    ('builtins', 'frozenset'): True,
+    ('collections', 'deque'): True,
+    # the convergence monitor and random state of the fitted hmm are not read, they become Skipped
+    ('hmmlearn.base', 'ConvergenceMonitor'): False,
+    ('numpy.random', 'RandomState'): False,
+    ('numpy.random.mtrand', 'RandomState'): False,
+    ('numpy.random._pickle', '__randomstate_ctor'): False,
+    ('numpy.random._pickle', '__bit_generator_ctor'): False,
+    ('numpy.random._mt19937', 'MT19937'): False,
+    ('numpy.random.bit_generator', 'SeedSequence'): False,
+    ('numpy.random.bit_generator', '__pyx_unpickle_SeedSequence'): False,
+}
+
+
+class Skipped:
+
+    def __init__(self, *args, **kwargs):
+        """
+        This is the constructor for a Skipped, which stands in for a pickled object the conversion does not
+        read, so the code of its class is never run.
+        """
+        pass
+
+    def __setstate__(self, state):
+        pass
+
+
+class HandlerUnpickler(pickle.Unpickler):
+
+    def find_class(self, module, name):
+        read = ALLOWED_GLOBALS.get((module, name))
+        if read is None:
+            raise pickle.UnpicklingError(module + '.' + name + ' is not part of a saved hmm')
+        if not read:
+            return Skipped
+        return super().find_class(module, name)
+
+
+def read_pickle(path):
+    """
+    Returns a handler for a handler pickled by an older version. Only the attributes of the pickled
+    handler are read: its config, the probabilities of its hmm and the notes it was played.
+    """
+    with open(path, 'rb') as file:
+        handler = HandlerUnpickler(file).load().__dict__
+    # older handlers miss the newer arguments, they get the defaults
+    config = {name: handler.get(name, parameter.default)
+              for name, parameter in inspect.signature(HMMHandler).parameters.items()}
+    hmm = handler['hmm'].__dict__
+    all_obs = handler.get('all_obs', [])
+    header = {
+        'config': config,
+        'states': list(hmm['states']),
+        'observations': list(hmm['observations']),
+        'prev_note': handler.get('prev_note', 0),
+        'octave': handler.get('octave', 4),
+        'obs_count': len(handler.get('obs_vector', [])),
+        'train_count': len(handler.get('train_vector', [])),
+        'all_obs': [list(so_pair) for so_pair in all_obs[max(len(all_obs) - config['window_size'], 0):]]
+    }
+    arrays = {'startprob': hmm['startprob_'], 'transmat': hmm['transmat_'], 'emissionprob': hmm['emissionprob_']}
+    return HMMHandler.from_saved_model(header, arrays)
+
+
+def convert(source=PICKLE_PATH, target=SAVE_PATH):
+    """
+    Writes every pickle in source as a saved hmm of the same name to target and adds it to the catalogue,
+    unless there is one already. The pickles are kept. Returns the names of the converted hmms.
+    """
+    os.makedirs(target, exist_ok=True)
+    catalogue = ModelCatalogue(os.path.join(target, 'catalogue.sqlite'))
+    converted = []
+    for filename in sorted(os.listdir(source)):
+        if not filename.endswith('.pkl'):
+            continue
+        name = filename[:-len('.pkl')]
+        path = os.path.join(target, name + model_io.EXTENSION)
+        if os.path.exists(path):
+            print(name + ' is saved already')
+            continue
+        try:
+            header, arrays = read_pickle(os.path.join(source, filename)).get_saved_model()
+            model_io.dump(path, header, arrays)
+        except Exception as e:
+            print('ERROR: could not convert ' + filename)
+            print(e)
+            continue
+        # the save time of the pickle keeps the order of the list
+        catalogue.add(name, header['config'], os.path.getsize(path), None, os.path.getmtime(
+            os.path.join(source, filename)))
+        converted.append(name)
+        print('converted ' + name)
+    return converted
+
+
+def main(argv):
+    arguments = argparse.ArgumentParser(description='Converts hmms saved as pickles into saved hmm files.')
+    arguments.add_argument('--source', default=PICKLE_PATH, help='directory of the .pkl files')
+    arguments.add_argument('--target', default=SAVE_PATH, help='directory of the saved hmms of the server')
+    options = arguments.parse_args(argv)
+    if not os.path.isdir(options.source):
+        print('ERROR: ' + options.source + ' is not a directory')
+        return 1
+    convert(options.source, options.target)
+    return 0
+
+
+if __name__ == '__main__':
+    # python convert_pickles.py --source pickle/ --target saved/
+    sys.exit(main(sys.argv[1:]))
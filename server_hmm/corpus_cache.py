@@ -0,0 +1,177 @@
+#!/usr/bin/python
+# This class handles the decoding of a midi corpus and keeps the decoded note events in memory, up to a limit.
+
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pretty_midi
+
+# bytes of decoded note events kept in memory, a jazz midi file takes about 100 KB
+MEMORY_LIMIT = 256 * 1024 * 1024
+
+
+class CorpusCache:
+
+    def __init__(self, workers=1, max_bytes=MEMORY_LIMIT):
+        """
+        This is the constructor for a CorpusCache, which decodes every midi file of a directory
+        once per process and hands out the decoded note events to every Parser asking for it.
+        Files are keyed by name, mtime and size, so changed files are decoded again.
+        With more than one worker, the files are decoded in a pool of worker processes.
+        Decoded files are kept until they take max_bytes, later files are decoded every time they
+        are needed. With max_bytes 0 nothing is kept and iter holds one file at a time.
+        """
+        self.workers = workers
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # (path, mtime, size) -> decoded events of one file
+        self.files = {}
+        # bytes of the decoded events in files
+        self.size = 0
+        # directory -> (corpus key, list of decoded events), only for directories with all files kept
+        self.corpora = {}
+
+    @staticmethod
+    def corpus_key(directory):
+        """
+        Returns a key describing the current state of the midi files in a directory.
+        The files are sorted by name, so the order does not depend on the file system.
+        """
+        files = []
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith('.mid'):
+                stat = os.stat(os.path.join(directory, filename))
+                files.append((filename, stat.st_mtime_ns, stat.st_size))
+        return os.path.abspath(directory), tuple(files)
+
+    def get(self, directory):
+        """
+        Returns the decoded events of all midi files in a directory as a list with one entry per file.
+        Every entry is a dict of numpy arrays with the pitch, duration (ms), velocity and rest (ms) of each note.
+        """
+        key = self.corpus_key(directory)
+        path = key[0]
+        with self.lock:
+            corpus = self.corpora.get(path)
+            if corpus is not None and corpus[0] == key:
+                return corpus[1]
+            file_keys = [(os.path.join(path, filename), mtime, size) for filename, mtime, size in key[1]]
+            missing = [file_key for file_key in file_keys if file_key not in self.files]
+            decoded = dict(zip(missing, self._decode_iter(missing)))
+            # every decoded file is offered to the cache, even after one did not fit
+            complete = all([self._keep(file_key, file_events) for file_key, file_events in decoded.items()])
+            events = [self.files.get(file_key, decoded.get(file_key)) for file_key in file_keys]
+            events = [file_events for file_events in events if file_events is not None]
+            self._set_corpus(key, file_keys, events if complete else None)
+            return events
+
+    def iter(self, directory):
+        """
+        Yields the decoded events of the midi files in a directory one by one, in the order of get.
+        A file is handed out as soon as it is decoded, so the caller can use it while the later files
+        are still decoded. The decoded files are cached like get does, as long as they fit into
+        max_bytes. The files which do not fit are only held until the caller takes the next one.
+        """
+        key = self.corpus_key(directory)
+        path = key[0]
+        with self.lock:
+            corpus = self.corpora.get(path)
+            cached = dict(self.files)
+        if corpus is not None and corpus[0] == key:
+            yield from corpus[1]
+            return
+        file_keys = [(os.path.join(path, filename), mtime, size) for filename, mtime, size in key[1]]
+        decoded = self._decode_iter([file_key for file_key in file_keys if file_key not in cached])
+        # the list of the corpus, until a file does not fit into the cache
+        events = []
+        for file_key in file_keys:
+            if file_key in cached:
+                file_events = cached[file_key]
+            else:
+                file_events = next(decoded)
+                with self.lock:
+                    if not self._keep(file_key, file_events):
+                        events = None
+            if file_events is not None:
+                if events is not None:
+                    events.append(file_events)
+                yield file_events
+        with self.lock:
+            self._set_corpus(key, file_keys, events)
+
+    def _keep(self, file_key, events):
+        # caches the decoded events of a file if they fit, returns whether they were kept
+        size = self.nbytes(events)
+        if self.size + size > self.max_bytes:
+            return False
+        self.files[file_key] = events
+        self.size += size
+        return True
+
+    @staticmethod
+    def nbytes(events):
+        return 0 if events is None else sum(array.nbytes for array in events.values())
+
+    def _set_corpus(self, key, file_keys, events):
+        path = key[0]
+        # forget old versions of the files in this directory
+        current = set(file_keys)
+        self.files = {k: v for k, v in self.files.items() if os.path.dirname(k[0]) != path or k in current}
+        self.size = sum(self.nbytes(v) for v in self.files.values())
+        if events is None:
+            self.corpora.pop(path, None)
+        else:
+            self.corpora[path] = (key, events)
+
+    def _decode_iter(self, file_keys):
+        # the decoded events of the files in their order
+        if self.workers > 1 and len(file_keys) > 1:
+            paths = [file_key[0] for file_key in file_keys]
+            chunksize = len(paths) // (self.workers * 4) + 1
+            with ProcessPoolExecutor(self.workers) as executor:
+                # map keeps the order of the files, whichever worker finishes first
+                yield from executor.map(self.decode, paths, chunksize=chunksize)
+        else:
+            for file_key in file_keys:
+                yield self.decode(file_key[0])
+
+    @staticmethod
+    def decode(path):
+        """
+        This function reads a midi file and returns its note events in playing order (pretty_midi).
+        The rest of a note is the time between the end of the previous note and its start.
+        """
+        try:
+            midi_data = pretty_midi.PrettyMIDI(path)
+        except:
+            return None
+        midi_data.remove_invalid_notes()
+        pitches = []
+        durations = []
+        velocities = []
+        rests = []
+        end = 0
+        for instrument in midi_data.instruments:
+            # (for jazz midi dataset preprocessing)
+            # if instrument.program in range(0, 7):
+            #     print(instrument.name)
+            #     print(instrument.program)
+            if not instrument.is_drum:
+                for note in instrument.notes:
+                    if note.pitch in range(21, 110):
+                        pitches.append(note.pitch)
+                        durations.append(note.duration * 1000)
+                        velocities.append(note.velocity)
+                        rests.append((note.start - end) * 1000)
+                        end = note.end
+        return {
+            'pitch': np.array(pitches, dtype=int),
+            'duration': np.array(durations, dtype=float),
+            'velocity': np.array(velocities, dtype=int),
+            'rest': np.array(rests, dtype=float)
+        }
+
+
+corpus_cache = CorpusCache()
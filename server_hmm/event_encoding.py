@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# This class handles the integer encoding of note events for hmms with a fixed vocabulary.
+
+import bisect
+
+import numpy as np
+
+from my_hmm import SOPair
+
+# type of the state and observation indices of encoded events
+EVENT_DTYPE = np.int32
+
+
+class EventEncoding:
+
+    def __init__(self, notes, durations, velocities, note_type='midikeys', layout='note-time'):
+        """
+        This is the constructor for an EventEncoding, which turns note events into the state and observation
+        indices of the vocabulary a Parser builds from notes, durations and velocities. The indices are
+        computed, not looked up: a note is its offset in notes, a duration or velocity the nearest one and
+        a joint observation note_index * len(durations) + duration_index. Events are rows of an (n, 2) array
+        of EVENT_DTYPE, SOPairs are only built by decode. The last note is the rest.
+        """
+        self.notes = notes
+        self.durations = durations
+        self.velocities = velocities
+        self.note_type = note_type
+        self.layout = layout
+        self.rest_index = len(notes) - 1
+        self.n_durations = len(durations)
+        self._durations = np.asarray(durations)
+        self._velocities = np.asarray(velocities)
+
+    def note_indices(self, notes, prev_notes, rests):
+        notes = np.asarray(notes)
+        if self.note_type == 'semitones':
+            indices = notes % 12
+        elif self.note_type == 'intervals':
+            # intervals of more than an octave are unisons
+            indices = notes - np.asarray(prev_notes)
+            indices[np.abs(indices) > 12] = 0
+            indices = indices + 12
+        else:
+            indices = np.clip(notes - self.notes[0], 0, self.rest_index)
+        indices[np.asarray(rests, dtype=bool)] = self.rest_index
+        return indices
+
+    def note_index(self, note, prev_note, rest):
+        if rest:
+            return self.rest_index
+        if self.note_type == 'semitones':
+            return note % 12
+        if self.note_type == 'intervals':
+            interval = note - prev_note
+            return 12 if abs(interval) > 12 else interval + 12
+        return min(max(note - self.notes[0], 0), self.rest_index)
+
+    def encode(self, notes, durations, prev_notes, velocities, rests):
+        """
+        Returns the events of arrays of notes as an (n, 2) array of state and observation indices.
+        Events marked in rests are rests, their notes are ignored.
+        """
+        note_indices = self.note_indices(notes, prev_notes, rests)
+        duration_indices = nearest_indices(self._durations, durations)
+        events = np.empty((len(note_indices), 2), dtype=EVENT_DTYPE)
+        if self.layout == 'joint':
+            events[:, 0] = 0
+            events[:, 1] = note_indices * self.n_durations + duration_indices
+        elif self.layout == 'velocity-joint':
+            events[:, 0] = nearest_indices(self._velocities, velocities)
+            events[:, 1] = note_indices * self.n_durations + duration_indices
+        elif self.layout == 'note-time':
+            events[:, 0] = note_indices
+            events[:, 1] = duration_indices
+        else:
+            events[:, 0] = duration_indices
+            events[:, 1] = note_indices
+        return events
+
+    def encode_one(self, note, duration, prev_note=0, velocity=100, rest=False):
+        """
+        Returns the state and observation index of a single event, like a row of encode.
+        """
+        note_index = self.note_index(note, prev_note, rest)
+        duration_index = nearest_index(self.durations, duration)
+        if self.layout == 'joint':
+            return 0, note_index * self.n_durations + duration_index
+        if self.layout == 'velocity-joint':
+            return nearest_index(self.velocities, velocity), note_index * self.n_durations + duration_index
+        if self.layout == 'note-time':
+            return note_index, duration_index
+        return duration_index, note_index
+
+
+def decode(events, states, observations):
+    # the so_pairs of events, with the vocabulary of the hmm
+    return [SOPair(states[s], observations[o]) for s, o in np.asarray(events).tolist()]
+
+
+def nearest_indices(array, values):
+    """
+    Returns the indices of the nearest values in a sorted array for an array of values,
+    on a tie the smaller value wins like in Parser._find_nearest.
+    """
+    array = np.asarray(array)
+    if len(array) == 1:
+        return np.zeros(len(values), dtype=int)
+    upper = np.clip(np.searchsorted(array, values), 1, len(array) - 1)
+    lower = upper - 1
+    return np.where(np.abs(array[lower] - values) <= np.abs(array[upper] - values), lower, upper)
+
+
+def nearest_index(array, value):
+    # nearest_indices for one value
+    upper = min(max(bisect.bisect_left(array, value), 1), len(array) - 1)
+    if upper == 0:
+        return 0
+    return upper - 1 if abs(array[upper - 1] - value) <= abs(array[upper] - value) else upper
@@ -3,17 +3,39 @@
 # This class handle music processing and generation with an hidden markov model
 
 from __future__ import print_function
+from gevent.threadpool import ThreadPoolExecutor
+from metrics import metrics
 from parser import Parser
+from model_io import symbols_from_json
+from my_hmm import SOPair
+from ring_buffer import RingBuffer
+from event_encoding import EVENT_DTYPE
+import logging
 import pretty_midi
 
+logger = logging.getLogger(__name__)
+
+# retraining and speculative sampling run in these threads when train_async or speculative is set, so the socket
+# handlers do not wait for them. They are native threads of gevent, also when the threading module is patched,
+# like by the gevent workers of gunicorn.
+executor = ThreadPoolExecutor(max_workers=4)
+
 
 class HMMHandler:
     def __init__(self, train=True, sample_rate=10, nr_samples=10, window_size=15, quantisation=50, layout='note-time',
                  train_diy=False, train_rate=10, files='midi/', init_type='zero', pretrain=True, weighting=50,
-                 note_type='midikeys', time_type='ms', triggering='note-based'):
-        self.obs_vector = []
-        self.train_vector = []
-        self.all_obs = []
+                 note_type='midikeys', time_type='ms', triggering='note-based', train_async=False, n_iter=1000,
+                 tol=1e-2, train_budget=None, engine='dense', speculative=False):
+        # notes (or beats) since the last sample and the last training
+        self.obs_count = 0
+        self.train_count = 0
+        # state and observation indices of the newest notes, the training window
+        self.history = RingBuffer(window_size, 2, EVENT_DTYPE)
+        # numbering of the symbols of flexible hmms, see _encode
+        self.flexible_states = []
+        self.flexible_state_index = {}
+        self.flexible_observations = []
+        self.flexible_observation_index = {}
         self.prev_note = 0
         self.octave = 4
         self.train = train
@@ -31,52 +53,353 @@ class HMMHandler:
         self.note_type = note_type
         self.time_type = time_type
         self.triggering = triggering
+        self.train_async = train_async
+        self.train_future = None
+        self.n_iter = n_iter
+        self.tol = tol
+        self.train_budget = train_budget
+        self.fit_report = None
+        self.engine = engine
+        self.speculative = speculative
+        # counts the changes of the probabilities, a speculation of an older version is discarded
+        self.model_version = 0
+        self.speculation = None
+        # name of the saved hmm this handler was loaded from
+        self.saved_name = None
         # self.enter = True
         self.parser = Parser(self.files, verbose=False, time_step=self.quantisation, end_range=2000,
                              layout=self.layout, init_type=self.init_type, pretrain=self.pretrain,
-                             note_type=self.note_type, time_type=time_type)
+                             note_type=self.note_type, time_type=time_type, engine=self.engine)
         self.hmm = self.parser.get_hmm()
+        self.hmm.set_fit_limits(self.n_iter, self.tol, self.train_budget)
+        # the probabilities the handler started with, the session store keeps the changes to them,
+        # random ones can not be built again
+        self.base_arrays = None if self.init_type == 'random' else self.get_arrays()
         # self.generator = Generator.load(self.hmm)
 
+    @metrics.timed('handler_call')
     def call(self, note, duration, velocity=100):
         # if self.enter:
         #     self.sample()
         #     self.enter = False
+        self._add_note(note, duration, velocity)
+        if self.triggering == 'note-based':
+            return self.check_for_triggering()
+        else:
+            return False
+
+    @metrics.timed('handler_call_batch')
+    def call_batch(self, notes):
+        """
+        Adds a batch of (note, duration, velocity) like call does one by one, but checks for training and
+        sampling once at the end. A batch gives at most one melody, from the probabilities after the batch.
+        """
+        for note, duration, velocity in notes:
+            self._add_note(note, duration, velocity)
+        if self.triggering == 'note-based' and notes:
+            return self.check_for_triggering()
+        return False
+
+    def _add_note(self, note, duration, velocity):
         duration = int(duration * 1000)
-        so_pair = self.parser.find_so_pair(note, duration, self.prev_note, velocity)
-        print(so_pair)
+        if self.parser.encoding is not None:
+            event = self.parser.find_event(note, duration, self.prev_note, velocity)
+        else:
+            event = self._encode(self.parser.find_so_pair(note, duration, self.prev_note, velocity))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s', self._decode(event))
         if note != self.parser.rest:
             self.octave = pretty_midi.note_number_to_name(note)[-1]
             self.prev_note = note
             if self.triggering == 'note-based':
-                self.obs_vector.append(so_pair)
-                self.train_vector.append(so_pair)
-            self.all_obs.append(so_pair)
+                self.obs_count += 1
+                self.train_count += 1
+            self.history.append(event)
         else:
             if self.parser.beats[3] <= duration <= self.parser.beats[len(self.parser.beats) - 1]:
-                self.all_obs.append(so_pair)
-        if self.triggering == 'note-based':
-            return self.check_for_triggering()
-        else:
-            return False
+                self.history.append(event)
 
+    @metrics.timed('handler_call_beat')
     def call_beat(self):
-        self.train_vector.append('beat')
-        self.obs_vector.append('beat')
+        self.train_count += 1
+        self.obs_count += 1
         return self.check_for_triggering()
 
+    @property
+    def window_size(self):
+        return self.history.capacity
+
+    @window_size.setter
+    def window_size(self, window_size):
+        if window_size != self.history.capacity:
+            self.history.resize(window_size)
+
+    def _encode(self, so_pair):
+        """
+        Returns the state and observation index of a so_pair for the history. Fixed vocabularies use
+        the indices of the hmm. Flexible hmms learn new symbols only when they train, so the handler
+        numbers their symbols itself.
+        """
+        if not self.hmm.flexible:
+            return self.hmm.state_index[so_pair.state], self.hmm.observation_index[so_pair.observation]
+        return (self._number(self.flexible_states, self.flexible_state_index, so_pair.state),
+                self._number(self.flexible_observations, self.flexible_observation_index, so_pair.observation))
+
+    @staticmethod
+    def _number(symbols, index, symbol):
+        if symbol not in index:
+            index[symbol] = len(symbols)
+            symbols.append(symbol)
+        return index[symbol]
+
+    def _decode(self, event):
+        if self.hmm.flexible:
+            return SOPair(self.flexible_states[event[0]], self.flexible_observations[event[1]])
+        return SOPair(self.hmm.states[event[0]], self.hmm.observations[event[1]])
+
+    def get_window(self):
+        """
+        Returns the so_pairs of the training window, oldest first.
+        """
+        return [self._decode(event) for event in self.history.window().tolist()]
+
+    def _get_training_window(self):
+        # indices of fixed vocabularies are the ones of the hmm, flexible hmms train on the so_pairs
+        if self.hmm.flexible:
+            return self.get_window()
+        return self.history.window()
+
+    @staticmethod
+    def _train_window(hmm, window, diy, weighting, pretrain):
+        if isinstance(window, list):
+            hmm.train(window, diy, weighting, pretrain)
+        else:
+            hmm.train_indices(window[:, 0], window[:, 1], diy, weighting, pretrain)
+
     def check_for_triggering(self):
-        if self.train and len(self.train_vector) == self.train_rate:
-            so_pairs = self.all_obs[-self.window_size:]
-            self.hmm.train(so_pairs, self.train_diy, self.weighting, self.pretrain)
-            self.train_vector = []
-        if len(self.obs_vector) == self.sample_rate:
-            self.obs_vector = []
+        self.swap_trained_hmm()
+        # a batch may add more notes than the rates, the rest counts for the next time
+        if self.train and self.train_count >= self.train_rate:
+            if self.train_async:
+                self.start_training()
+            else:
+                self._train_window(self.hmm, self._get_training_window(), self.train_diy, self.weighting,
+                                   self.pretrain)
+                self.model_version += 1
+                self.report_training(self.hmm.fit_report)
+            self.train_count %= self.train_rate
+        if self.obs_count >= self.sample_rate:
+            self.obs_count %= self.sample_rate
             return self.sample(self.octave, self.prev_note)
+        self.speculate()
         return False
 
+    def start_training(self):
+        """
+        Trains a copy of the hmm in the executor. Until it is done, samples are drawn from the current hmm.
+        If the previous training is still running, this window is skipped.
+        """
+        if self.train_future is not None:
+            return
+        hmm = self.hmm.training_copy()
+        window = self._get_training_window()
+        if not isinstance(window, list):
+            # the history is written on while the copy trains
+            window = window.copy()
+        self.train_future = executor.submit(self._train_copy, hmm, window, self.train_diy, self.weighting,
+                                            self.pretrain)
+
+    @classmethod
+    def _train_copy(cls, hmm, window, diy, weighting, pretrain):
+        cls._train_window(hmm, window, diy, weighting, pretrain)
+        return hmm.get_parameters(), hmm.fit_report
+
+    def swap_trained_hmm(self):
+        """
+        Replaces the probabilities of the hmm with the ones of a finished training at once.
+        """
+        if self.train_future is None or not self.train_future.done():
+            return False
+        future = self.train_future
+        self.train_future = None
+        try:
+            params, fit_report = future.result()
+        except Exception as e:
+            print('ERROR: training failed')
+            print(e)
+            return False
+        self.hmm.set_parameters(params)
+        self.model_version += 1
+        self.report_training(fit_report)
+        return True
+
+    def report_training(self, fit_report):
+        # remember how many Baum-Welch iterations the last training took, to tune n_iter, tol and train_budget
+        self.fit_report = fit_report
+        if fit_report is not None:
+            logger.info('trained in %d iterations (%.3fs, converged: %s)',
+                        fit_report['iterations'], fit_report['seconds'], fit_report['converged'])
+
+    def __getstate__(self):
+        # a running training can not be pickled
+        state = self.__dict__.copy()
+        state['train_future'] = None
+        state['speculation'] = None
+        return state
+
+    def get_config(self):
+        """
+        Returns the arguments this handler was created with, except the training limits of the server.
+        """
+        return {
+            'train': self.train,
+            'sample_rate': self.sample_rate,
+            'nr_samples': self.nr_samples,
+            'window_size': self.window_size,
+            'quantisation': self.quantisation,
+            'layout': self.layout,
+            'train_diy': self.train_diy,
+            'train_rate': self.train_rate,
+            'files': self.files,
+            'init_type': self.init_type,
+            'pretrain': self.pretrain,
+            'weighting': self.weighting,
+            'note_type': self.note_type,
+            'time_type': self.time_type,
+            'triggering': self.triggering,
+            'engine': self.parser.engine
+        }
+
+    def get_saved_model(self):
+        """
+        Returns the json header and the arrays model_io.dump writes for this handler: the config,
+        the vocabularies, the probabilities and the notes of the current training window.
+        Older notes are not saved, they are never trained on again.
+        """
+        params = dict(self.hmm.get_parameters())
+        header = {
+            'config': self.get_config(),
+            'corpus': self.parser.corpus,
+            'states': list(params.pop('states')),
+            'observations': list(params.pop('observations')),
+            'prev_note': self.prev_note,
+            'octave': self.octave,
+            'obs_count': self.obs_count,
+            'train_count': self.train_count,
+            'all_obs': [list(so_pair) for so_pair in self.get_window()]
+        }
+        return header, params
+
+    @classmethod
+    def from_saved_model(cls, header, arrays, **kwargs):
+        """
+        Creates a handler from the header and arrays model_io.load returns, without pretraining.
+        The keyword arguments are passed to the constructor, like the training limits of the server.
+        """
+        config = dict(header['config'], **kwargs)
+        pretrain = config['pretrain']
+        config['pretrain'] = False
+        handler = cls(**config)
+        handler.pretrain = pretrain
+        handler.parser.corpus = header.get('corpus')
+        params = dict(arrays)
+        params['states'] = symbols_from_json(header['states'])
+        params['observations'] = symbols_from_json(header['observations'])
+        handler.hmm.set_parameters(params)
+        handler.base_arrays = handler.get_arrays()
+        handler.restore_state(header)
+        return handler
+
+    def get_arrays(self):
+        # the probabilities of the hmm, without the vocabularies
+        return {name: array for name, array in self.hmm.get_parameters().items()
+                if name not in ('states', 'observations')}
+
+    def get_state(self):
+        """
+        Returns the part of the handler which changes while playing, without the probabilities.
+        """
+        return {
+            'config': self.get_config(),
+            'saved_name': self.saved_name,
+            'model_version': self.model_version,
+            'prev_note': self.prev_note,
+            'octave': self.octave,
+            'obs_count': self.obs_count,
+            'train_count': self.train_count,
+            'all_obs': [list(so_pair) for so_pair in self.get_window()]
+        }
+
+    def restore_state(self, state):
+        self.prev_note = state['prev_note']
+        self.octave = state['octave']
+        self.model_version = state.get('model_version', 0)
+        # older files kept the notes since the last sample and training instead of their numbers
+        self.obs_count = state.get('obs_count', len(state.get('obs_vector', [])))
+        self.train_count = state.get('train_count', len(state.get('train_vector', [])))
+        self.history.clear()
+        for so_pair in state['all_obs']:
+            self.history.append(self._encode(SOPair(*symbols_from_json(so_pair))))
+
+    def get_overlay(self):
+        """
+        Returns the header and arrays of get_saved_model if the probabilities can not be built again
+        from the config or the saved hmm, because they were trained or randomly initialised, else None.
+        Random ones, also pretrained ones, have no base_arrays.
+        """
+        if self.model_version == 0 and self.base_arrays is not None:
+            return None
+        return self.get_saved_model()
+
+    def speculate(self):
+        """
+        Samples the next continuation in the executor while the player fills the window, unless
+        there is one for the current probabilities already. It is rendered for the current notes,
+        so at the trigger it is sent as it is, or only rendered again if the octave or note changed.
+        """
+        if not self.speculative:
+            return
+        if self.speculation is not None and self.speculation[0] == self._speculation_key():
+            return
+        self.speculation = (self._speculation_key(),
+                            executor.submit(self._speculate, self.nr_samples, self.octave, self.prev_note))
+
+    def _speculate(self, nr_samples, octave, prev_note):
+        samples = self.hmm.get_sample_so_pairs(nr_samples)
+        return samples, self._render_key(octave, prev_note), self._render(samples, octave, prev_note)
+
+    def _speculation_key(self):
+        return self.model_version, self.nr_samples
+
+    def _render_key(self, octave, prev_note):
+        # the parts of the notes the rendering depends on
+        return (octave if self.note_type == 'semitones' else None,
+                prev_note if self.note_type == 'intervals' else None)
+
+    def _take_speculation(self, octave, prev_note):
+        # the rendered speculation, or None if there is none for the current probabilities yet
+        speculation, self.speculation = self.speculation, None
+        if speculation is None or speculation[0] != self._speculation_key() or not speculation[1].done():
+            return None
+        try:
+            samples, render_key, rendered = speculation[1].result()
+        except Exception as e:
+            print('ERROR: speculative sampling failed')
+            print(e)
+            return None
+        if render_key == self._render_key(octave, prev_note):
+            return rendered
+        return self._render(samples, octave, prev_note)
+
+    @metrics.timed('handler_sample')
     def sample(self, octave, prev_note):
-        samples = self.hmm.get_sample_so_pairs(self.nr_samples)
+        rendered = self._take_speculation(octave, prev_note)
+        if rendered is None:
+            rendered = self._render(self.hmm.get_sample_so_pairs(self.nr_samples), octave, prev_note)
+        self.speculate()
+        return rendered
+
+    def _render(self, samples, octave, prev_note):
         # self.generator.gen_live("../out/live.mid", sample)
         midi_instrument = pretty_midi.Instrument(program=0)
         time_start = 0
@@ -119,6 +442,7 @@ class HMMHandler:
         return pretty_note
 
     @staticmethod
+    @metrics.timed('sample_to_json')
     def _sample_to_json(generated_sequence):
         notes = []
         for seq_note in generated_sequence.notes:
@@ -0,0 +1,215 @@
+#!/usr/bin/python
+# This class handles the load test of the server with simulated players replaying midi performances.
+
+import argparse
+import collections
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+import socketio
+
+from note_tracker import read_performance
+
+URL = 'http://localhost:8080'
+CONFIG = 'test.json'
+PERFORMANCES = 'piano/'
+# seconds for pretraining after the submit, the server does not answer it
+SETTLE = 2.0
+
+
+class SimulatedPlayer:
+
+    def __init__(self, url, config, performance, duration, speed=1.0, batch=0.0):
+        """
+        This is the constructor for a SimulatedPlayer, which connects to the server, submits a config and
+        plays a performance in real time as keydown and keyup messages, or as noteEvents batches
+        of batch seconds. It measures the connect time and the time from the key event that
+        triggered a melody to the melody. The server acknowledges every key event with whether it
+        triggered a melody, so a slow server does not shorten the time to that of a later key event.
+        """
+        self.url = url
+        self.config = config
+        self.performance = performance
+        self.duration = duration
+        self.speed = speed
+        self.batch = batch
+        self.client = socketio.Client(reconnection=False)
+        self.client.on('predicted-melody', self._on_melody)
+        self.connect_time = None
+        self.latencies = []
+        self.key_events = 0
+        self.error = None
+        # times the triggering key events were sent and the melodies arrived, not matched yet. With a message
+        # queue a melody may arrive after the acknowledgement of its key event.
+        self.triggers = collections.deque()
+        self.melodies = collections.deque()
+
+    def _on_melody(self, melody):
+        self.melodies.append(time.perf_counter())
+        self._match()
+
+    def _on_ack(self, sent, triggered):
+        if triggered:
+            self.triggers.append(sent)
+            self._match()
+
+    def _match(self):
+        while self.triggers and self.melodies:
+            self.latencies.append(self.melodies.popleft() - self.triggers.popleft())
+
+    def _emit(self, event, data):
+        sent = time.perf_counter()
+        self.client.emit(event, data, callback=lambda triggered=False: self._on_ack(sent, triggered))
+
+    def run(self):
+        try:
+            start = time.perf_counter()
+            self.client.connect(self.url)
+            self.connect_time = time.perf_counter() - start
+            self.client.emit('submit', json.dumps(self.config))
+            time.sleep(SETTLE)
+            self._play()
+            # the melody of the last key events may still be on its way
+            time.sleep(0.5)
+        except Exception as e:
+            self.error = repr(e)
+        finally:
+            if self.client.connected:
+                self.client.disconnect()
+
+    def _play(self):
+        start = time.perf_counter()
+        offset = self.performance[0][0]
+        pending = []
+        for event_time, is_down, pitch, velocity in self.performance:
+            at = (event_time - offset) / self.speed
+            if at > self.duration:
+                break
+            if pending and at >= pending[0]['time'] / 1000 + self.batch:
+                # the client sends a batch when its time is over
+                self._wait(start + pending[0]['time'] / 1000 + self.batch)
+                self._flush(pending)
+                pending = []
+            self._wait(start + at)
+            if self.batch:
+                pending.append({'type': 'down' if is_down else 'up', 'note': pitch, 'velocity': velocity,
+                                'time': at * 1000})
+            else:
+                self._emit('keydown' if is_down else 'keyup', {'note': pitch, 'velocity': velocity})
+                self.key_events += 1
+        if pending:
+            self._wait(start + pending[0]['time'] / 1000 + self.batch)
+            self._flush(pending)
+
+    @staticmethod
+    def _wait(until):
+        wait = until - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+
+    def _flush(self, events):
+        self._emit('noteEvents', events)
+        self.key_events += len(events)
+
+
+def percentiles(values):
+    if not values:
+        return None, None, None
+    return tuple(np.percentile(values, [50, 95, 99]))
+
+
+def run_step(n_clients, options, config, performances):
+    """
+    Plays with n_clients players at once and returns their connect times, latencies, key events and errors.
+    """
+    players = [SimulatedPlayer(options.url, config, performances[i % len(performances)], options.duration,
+                               options.speed, options.batch) for i in range(n_clients)]
+    threads = [threading.Thread(target=player.run) for player in players]
+    for thread in threads:
+        thread.start()
+        # players do not all press their first key in the same millisecond
+        time.sleep(options.ramp / max(n_clients, 1))
+    for thread in threads:
+        thread.join()
+    return {
+        'clients': n_clients,
+        'connect': [player.connect_time for player in players if player.connect_time is not None],
+        'latency': [latency for player in players for latency in player.latencies],
+        'key_events': sum(player.key_events for player in players),
+        'errors': [player.error for player in players if player.error is not None]
+    }
+
+
+def start_server(url):
+    # the server listens on port 8080 of all interfaces
+    process = subprocess.Popen([sys.executable, 'server.py'], stdout=subprocess.DEVNULL)
+    host = url.split('://')[-1].split(':')[0]
+    for _ in range(600):
+        try:
+            socket.create_connection((host, 8080), timeout=0.1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('the server did not start')
+
+
+def main(argv):
+    arguments = argparse.ArgumentParser(description='Replays midi performances with simulated players.')
+    arguments.add_argument('--url', default=URL)
+    arguments.add_argument('--clients', default='1,2,5,10', help='numbers of players to play with, one step each')
+    arguments.add_argument('--config', default=CONFIG, help='json of the submit message')
+    arguments.add_argument('--midi', default=PERFORMANCES, help='midi file or directory of the performances')
+    arguments.add_argument('--duration', type=float, default=30.0, help='seconds every player plays')
+    arguments.add_argument('--speed', type=float, default=1.0, help='tempo factor of the performances')
+    arguments.add_argument('--batch', type=float, default=0.0,
+                           help='send noteEvents batches of this many seconds instead of single key events')
+    arguments.add_argument('--ramp', type=float, default=1.0, help='seconds to connect all players of a step')
+    arguments.add_argument('--start-server', action='store_true', help='run server.py for the test')
+    arguments.add_argument('--output', help='write the measurements of every step to this json file')
+    options = arguments.parse_args(argv)
+    with open(options.config) as file:
+        config = json.load(file)
+    # test.json names the training type like older clients
+    config.setdefault('diy', 'diy' if config.get('train-type') == 'diy' else 'normal')
+    steps = list(map(int, options.clients.split(',')))
+    if os.path.isdir(options.midi):
+        paths = [os.path.join(options.midi, filename) for filename in sorted(os.listdir(options.midi))
+                 if filename.endswith('.mid')]
+    else:
+        paths = [options.midi]
+    # one performance per player of the largest step
+    performances = [performance for performance in map(read_performance, paths[:max(steps)]) if performance]
+    server = start_server(options.url) if options.start_server else None
+    results = []
+    try:
+        print('{:>7} {:>10} {:>10} {:>10} {:>10} {:>10} {:>9} {:>7}'.format(
+            'clients', 'connect ms', 'p50 ms', 'p95 ms', 'p99 ms', 'melodies', 'events/s', 'errors'))
+        for n_clients in steps:
+            step = run_step(n_clients, options, config, performances)
+            results.append(step)
+            connect = np.median(step['connect']) * 1000 if step['connect'] else float('nan')
+            p50, p95, p99 = (float('nan') if p is None else p * 1000 for p in percentiles(step['latency']))
+            print('{:>7} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10} {:>9.0f} {:>7}'.format(
+                n_clients, connect, p50, p95, p99, len(step['latency']), step['key_events'] / options.duration,
+                len(step['errors'])))
+            for error in set(step['errors']):
+                print('ERROR: ' + error)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    if options.output:
+        with open(options.output, 'w') as file:
+            json.dump(results, file, indent=1)
+
+
+if __name__ == '__main__':
+    # python load_test.py --start-server --clients 1,5,10,20 --midi jazz_midi/
+    main(sys.argv[1:])
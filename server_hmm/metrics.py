@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# This class handles the latency histograms and session counters of the server.
+
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds of the histogram buckets in seconds, the last bucket takes the rest
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+
+class Histogram:
+
+    def __init__(self):
+        """
+        This is the constructor for a Histogram, which counts the observed seconds in fixed buckets.
+        Observing is a search in the bucket bounds, the memory does not grow with the observations.
+        """
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+class Metrics:
+
+    def __init__(self):
+        """
+        This is the constructor for a Metrics, which keeps a histogram per stage of the way from a key event
+        to a melody and counters per session. Stages are timed in the socket handlers and in the training
+        and sampling threads, so every change takes the lock.
+        """
+        self.lock = threading.Lock()
+        # stage -> Histogram
+        self.histograms = {}
+        # sid -> {counter name -> count}
+        self.sessions = {}
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def timed(self, stage):
+        """
+        Returns a decorator which observes the seconds every call of a function takes as stage.
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.observe(stage, time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def count(self, sid, name, n=1):
+        with self.lock:
+            counters = self.sessions.setdefault(sid, {})
+            counters[name] = counters.get(name, 0) + n
+
+    def drop_session(self, sid):
+        # the counters of a closed session are not exported any more
+        with self.lock:
+            self.sessions.pop(sid, None)
+
+    def render(self):
+        """
+        Returns the histograms and counters in the prometheus text format.
+        """
+        lines = ['# HELP hmm_stage_seconds Seconds spent in a stage between key events and melodies.',
+                 '# TYPE hmm_stage_seconds histogram']
+        with self.lock:
+            for stage, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append('hmm_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(stage, bound, cumulative))
+                lines.append('hmm_stage_seconds_sum{{stage="{}"}} {}'.format(stage, histogram.sum))
+                lines.append('hmm_stage_seconds_count{{stage="{}"}} {}'.format(stage, histogram.count))
+            lines.append('# HELP hmm_session_events_total Events of the connected sessions.')
+            lines.append('# TYPE hmm_session_events_total counter')
+            for sid, counters in sorted(self.sessions.items()):
+                for name, count in sorted(counters.items()):
+                    lines.append('hmm_session_events_total{{session="{}",event="{}"}} {}'.format(sid, name, count))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
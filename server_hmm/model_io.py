@@ -0,0 +1,128 @@
+#!/usr/bin/python
+# This class handles the binary file format of saved hmms.
+
+import io
+import json
+import os
+import struct
+
+import numpy as np
+
+MAGIC = b'HMMMODEL'
+VERSION = 1
+EXTENSION = '.hmm'
+# every array starts at a multiple of this, so it can be memory mapped
+ALIGNMENT = 64
+
+
+def dump(path, header, arrays):
+    """
+    Writes a json header and named numpy arrays to a file. The file starts with the magic bytes,
+    the format version and the length of the header, followed by the header and the raw arrays.
+    It is written under a temporary name and renamed, so a reader never sees half a file.
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as file:
+        _write(file, header, arrays)
+    os.replace(tmp, path)
+
+
+def dumps(header, arrays):
+    """
+    Returns the bytes dump would write, for keeping a model outside of the file system.
+    """
+    file = io.BytesIO()
+    _write(file, header, arrays)
+    return file.getvalue()
+
+
+def _write(file, header, arrays):
+    entries = {}
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        if array.dtype.hasobject:
+            raise ValueError('Array ' + name + ' holds python objects')
+        entries[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset = _align(offset + array.nbytes)
+    header = dict(header, arrays=entries)
+    header_bytes = json.dumps(header, default=to_json).encode()
+    prefix = MAGIC + struct.pack('<II', VERSION, len(header_bytes))
+    data_start = _align(len(prefix) + len(header_bytes))
+    file.write(prefix)
+    file.write(header_bytes)
+    for name, array in arrays.items():
+        file.seek(data_start + entries[name]['offset'])
+        file.write(np.ascontiguousarray(array).tobytes())
+
+
+def load(path):
+    """
+    Reads a file written by dump and returns the header and a dict of the arrays. The arrays are
+    memory mapped read-only, so loading takes the same time for every size of hmm.
+    Nothing in the file is executed, a file which is not in this format raises a ValueError.
+    """
+    with open(path, 'rb') as file:
+        header, data_start = _read_header(file, path)
+    return header, _map_arrays(header, lambda dtype, offset, shape: np.memmap(
+        path, dtype=dtype, mode='r', offset=data_start + offset, shape=shape))
+
+
+def loads(data, name='model'):
+    """
+    Reads the bytes written by dumps. The arrays are read-only views of data.
+    """
+    header, data_start = _read_header(io.BytesIO(data), name)
+    return header, _map_arrays(header, lambda dtype, offset, shape: np.frombuffer(
+        data, dtype=dtype, count=int(np.prod(shape)), offset=data_start + offset).reshape(shape))
+
+
+def _map_arrays(header, view):
+    arrays = {}
+    for name, entry in header.pop('arrays').items():
+        dtype = np.dtype(entry['dtype'])
+        shape = tuple(entry['shape'])
+        if dtype.hasobject:
+            raise ValueError('Array ' + name + ' holds python objects')
+        if dtype.itemsize * int(np.prod(shape)) == 0:
+            # empty arrays can not be mapped
+            arrays[name] = np.zeros(shape, dtype=dtype)
+        else:
+            arrays[name] = view(dtype, entry['offset'], shape)
+    return arrays
+
+
+def load_header(path):
+    """
+    Returns the header of a file written by dump without the arrays.
+    """
+    with open(path, 'rb') as file:
+        header = _read_header(file, path)[0]
+    header.pop('arrays')
+    return header
+
+
+def _read_header(file, path):
+    prefix = file.read(len(MAGIC) + 8)
+    if len(prefix) < len(MAGIC) + 8 or prefix[:len(MAGIC)] != MAGIC:
+        raise ValueError(path + ' is not a saved hmm')
+    version, header_length = struct.unpack('<II', prefix[len(MAGIC):])
+    if version > VERSION:
+        raise ValueError(path + ' was saved by a newer version (' + str(version) + ')')
+    header = json.loads(file.read(header_length).decode())
+    return header, _align(len(prefix) + header_length)
+
+
+def symbols_from_json(symbols):
+    # joint observations are stored as lists
+    return [tuple(symbol) if isinstance(symbol, list) else symbol for symbol in symbols]
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(repr(value) + ' can not be saved')
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# This class handles the storage of pretrained hmms on disk.
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+
+from model_io import symbols_from_json
+
+
+class ModelStore:
+
+    def __init__(self, path='pretrained/'):
+        """
+        This is the constructor for a ModelStore, which saves the probabilities of a pretrained hmm
+        for every parser configuration and corpus state, so they can be loaded instead of retrained.
+        Loaded models are kept read-only in memory and shared by every hmm of the same configuration.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        # key -> loaded parameters, shared by all sessions
+        self.shared = {}
+
+    @staticmethod
+    def get_key(config, corpus_key):
+        """
+        Returns the name of a stored model. The first part depends on the parser configuration only,
+        the second part on the state of the corpus the model was trained on.
+        """
+        config_hash = hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+        return config_hash + '-' + ModelStore.corpus_hash(corpus_key)
+
+    @staticmethod
+    def corpus_hash(corpus_key):
+        # short name of a corpus state, see CorpusCache.corpus_key
+        return hashlib.sha1(repr(corpus_key).encode()).hexdigest()[:16]
+
+    def load(self, key):
+        """
+        Returns the stored parameters for a key or None. The arrays are memory mapped read-only and
+        the same arrays are handed to every hmm asking for the key, so the probabilities exist once
+        per process however many sessions use them. An hmm replaces them by its own arrays
+        the first time it trains, so only retrained sessions need memory of their own.
+        """
+        with self.lock:
+            params = self.shared.get(key)
+            if params is None:
+                params = self._read(key)
+                if params is None:
+                    return None
+                self.shared[key] = params
+        return dict(params)
+
+    def _read(self, key):
+        directory = os.path.join(self.path, key)
+        try:
+            with open(os.path.join(directory, 'vocabulary.json')) as file:
+                params = json.load(file)
+            for name in params.pop('arrays'):
+                params[name] = np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+        except (OSError, ValueError, KeyError):
+            return None
+        params['states'] = symbols_from_json(params['states'])
+        params['observations'] = symbols_from_json(params['observations'])
+        return params
+
+    def save(self, key, params):
+        """
+        Saves the parameters for a key and removes the models of the same configuration
+        which were trained on an older state of the corpus.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=self.path)
+        try:
+            arrays = [name for name in params if name not in ('states', 'observations')]
+            with open(os.path.join(tmp, 'vocabulary.json'), 'w') as file:
+                json.dump({'states': list(params['states']), 'observations': list(params['observations']),
+                           'arrays': arrays}, file)
+            for name in arrays:
+                np.save(os.path.join(tmp, name + '.npy'), np.asarray(params[name]))
+            os.rename(tmp, os.path.join(self.path, key))
+        except OSError:
+            # another process saved the same model in the meantime
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        config_hash = key.split('-')[0]
+        for name in os.listdir(self.path):
+            if name.startswith(config_hash + '-') and name != key:
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+        with self.lock:
+            # sessions still using an old model keep their mapping until they let go of it
+            for name in list(self.shared):
+                if name.startswith(config_hash + '-') and name != key:
+                    del self.shared[name]
+
+
+model_store = ModelStore()
@@ -5,13 +5,141 @@ from sklearn import preprocessing
 import numpy as np
 import numpy.random
 from collections import namedtuple
+from sklearn.utils import check_array, check_random_state
 import scipy.stats as st
+import copy
+import functools
+import threading
+import time
+from metrics import metrics
 
 SOPair = namedtuple('SOPair', ['state', 'observation'])
 
 
-class HiddenMarkovModel(MultinomialHMM):
-    def __init__(self, states, observations, init='zero', multitone=False, vice_versa=False):
+@functools.lru_cache(maxsize=64)
+def symbol_index(symbols):
+    """
+    Returns a dict from every symbol of the tuple to its index. The dicts are shared by all hmms with
+    the same vocabulary and must not be changed.
+    """
+    return {symbol: i for i, symbol in enumerate(symbols)}
+
+
+# ids of shared read-only probabilities -> (probabilities, cumulative sums), see _get_cdfs.
+# Training and sampling threads use it at once, every access takes the lock.
+shared_cdfs = {}
+shared_cdfs_lock = threading.Lock()
+
+
+def chunk_sequences(chunks):
+    """
+    Yields the state and observation indices of every chunk of (n, 2) events, see train_chunks.
+    The last event of a chunk is carried over to the front of the next one, so it is counted
+    with its successor.
+    """
+    last = None
+    for events in chunks:
+        events = np.asarray(events, dtype=int)
+        state_indices, observation_indices = events[:, 0], events[:, 1]
+        if last is not None:
+            state_indices = np.concatenate(([last[0]], state_indices))
+            observation_indices = np.concatenate(([last[1]], observation_indices))
+        yield state_indices, observation_indices
+        if len(state_indices):
+            last = state_indices[-1], observation_indices[-1]
+
+
+class HmmTraining:
+    """
+    The training both hmm engines share: blending with the old probabilities, the Baum-Welch loop with
+    its limits and the counting of chunks. An engine names its probabilities in PROBABILITIES and
+    implements the steps: _fit_window, _start_fit and _em_step, _start_counts, _add_counts and
+    _finish_counts, and _blend_matrix.
+    """
+    PROBABILITIES = ('startprob_', 'transmat_', 'emissionprob_')
+
+    def _get_probabilities(self):
+        return tuple(getattr(self, name) for name in self.PROBABILITIES)
+
+    def get_index_vectors(self, so_pairs):
+        state_indices = np.fromiter((self.state_index[so_pair.state] for so_pair in so_pairs), dtype=int,
+                                    count=len(so_pairs))
+        observation_indices = np.fromiter((self.observation_index[so_pair.observation] for so_pair in so_pairs),
+                                          dtype=int, count=len(so_pairs))
+        return state_indices, observation_indices
+
+    @metrics.timed('hmm_train')
+    def train_indices(self, state_indices, observation_indices, diy=False, weight=50, pretrain=True):
+        """
+        This function trains the hmm like train, on the state and observation indices of the so_pairs.
+        """
+        weight = weight / 100
+        self.fit_report = None
+        # remember old probabilities
+        old_probabilities = self._get_probabilities()
+        # train new probabilities
+        self._fit_window(state_indices, observation_indices, diy, pretrain)
+        self._blend(old_probabilities, weight)
+
+    @metrics.timed('hmm_pretrain')
+    def train_chunks(self, chunks, weight=50):
+        """
+        This function trains the hmm like train with diy on the events of all chunks in a row, but counts
+        them one chunk at a time, so the events of all chunks do not have to be in memory at once.
+        A chunk is an (n, 2) array of state and observation indices, see index_so_pairs.
+        The last event of a chunk is counted with its successor, the first event of the next chunk.
+        """
+        weight = weight / 100
+        self.fit_report = None
+        old_probabilities = self._get_probabilities()
+        counts = self._start_counts()
+        for state_indices, observation_indices in chunk_sequences(chunks):
+            counts = self._add_counts(counts, state_indices, observation_indices)
+        self._blend(self._finish_counts(counts, old_probabilities), weight)
+
+    def _blend(self, old_probabilities, weight):
+        # calculate weighted probabilities from old and new
+        for name, old in zip(self.PROBABILITIES, old_probabilities):
+            setattr(self, name, self._blend_matrix(getattr(self, name), old, weight))
+
+    def set_fit_limits(self, n_iter=1000, tol=1e-2, time_budget=None):
+        self.n_iter = n_iter
+        self.tol = tol
+        self.time_budget = time_budget
+
+    @metrics.timed('hmm_fit')
+    def fit_budgeted(self, X):
+        """
+        This function runs Baum-Welch iterations on X, starting from the current probabilities.
+        It stops after n_iter iterations, when the log likelihood improves less than tol or when
+        time_budget seconds are used up. The number of iterations is reported in fit_report.
+        """
+        X = self._start_fit(X)
+        start = time.time()
+        logprob = prev_logprob = None
+        iterations = 0
+        converged = False
+        for _ in range(self.n_iter):
+            logprob = self._em_step(X)
+            iterations += 1
+            if prev_logprob is not None and logprob - prev_logprob < self.tol:
+                converged = True
+                break
+            prev_logprob = logprob
+            if self.time_budget is not None and time.time() - start >= self.time_budget:
+                break
+        self.fit_report = {
+            'iterations': iterations,
+            'log_likelihood': logprob,
+            'converged': converged,
+            'seconds': time.time() - start
+        }
+        return self
+
+
+class HiddenMarkovModel(HmmTraining, MultinomialHMM):
+    def __init__(self, states, observations, init='zero', multitone=False, vice_versa=False, n_iter=1000, tol=1e-2,
+                 time_budget=None):
         self.init = init
         self.multitone = multitone
         self.states = states
@@ -20,7 +148,12 @@ class HiddenMarkovModel(MultinomialHMM):
         self.n_observations = len(self.observations)
         self.vice_versa = vice_versa
         self.flexible = False
-        MultinomialHMM.__init__(self, n_components=self.n_states, n_iter=1000, init_params="")
+        # wall clock seconds a single fit may take, None for no limit
+        self.time_budget = time_budget
+        self.fit_report = None
+        # cumulative sums of the probabilities, built by the first sample after a change
+        self._cdfs = None
+        MultinomialHMM.__init__(self, n_components=self.n_states, n_iter=n_iter, tol=tol, init_params="")
         if init == 'random':
             self._init_random()
         elif init == 'zero':
@@ -36,6 +169,7 @@ class HiddenMarkovModel(MultinomialHMM):
             self.n_observations = len(self.observations)
             self.flexible = True
             self._init_empty()
+        self._index_symbols()
 
     # overwrite
     def _check_and_set_n_features(self, X):
@@ -55,6 +189,12 @@ class HiddenMarkovModel(MultinomialHMM):
                         .format(X.max(), self.n_features - 1))
         self.n_features = getattr(self, "n_features", self.emissionprob_.shape[1])
 
+    def _index_symbols(self):
+        # dicts from symbol to index, to avoid linear list searches
+        self.state_index = symbol_index(tuple(self.states))
+        self.observation_index = symbol_index(tuple(self.observations))
+        self.shared_index = True
+
     def _init_random(self):
         self.startprob_ = np.random.rand(self.n_states)
         self.transmat_ = np.random.rand(self.n_states, self.n_states)
@@ -129,63 +269,218 @@ class HiddenMarkovModel(MultinomialHMM):
     def set_emissionprob(self, emissionprob):
         self.emissionprob_ = emissionprob
 
+    def get_parameters(self):
+        return {
+            'states': self.states,
+            'observations': self.observations,
+            'startprob': self.startprob_,
+            'transmat': self.transmat_,
+            'emissionprob': self.emissionprob_
+        }
+
+    def set_parameters(self, params):
+        self.states = list(params['states'])
+        self.n_states = len(self.states)
+        self.observations = list(params['observations'])
+        self.n_observations = len(self.observations)
+        self.startprob_ = params['startprob']
+        self.transmat_ = params['transmat']
+        self.emissionprob_ = params['emissionprob']
+        self.n_components = self.n_states
+        if self.flexible:
+            self.n_features = self.n_observations
+        self._index_symbols()
+
+    def training_copy(self):
+        """
+        Returns a copy of the hmm to train in another thread. Training replaces the probability arrays
+        instead of changing them, so the copy shares them, only the vocabularies are copied.
+        """
+        hmm = copy.copy(self)
+        hmm.states = list(self.states)
+        hmm.observations = list(self.observations)
+        hmm.shared_index = True
+        return hmm
+
     def get_sample(self, nr_samples):
         return self.sample(nr_samples)
 
     def train(self, so_pairs, diy=False, weight=50, pretrain=True):
-        weight = weight / 100
-        # extend probabilities for flexible model
+        # extend probabilities for flexible model, once for all new symbols
         if self.flexible:
-            for so_pair in so_pairs:
-                self.extend_probabilities(so_pair)
-        # remember old probabilities
-        old_starts = self.startprob_
-        old_transmat = self.transmat_
-        old_emissions = self.emissionprob_
-        # train new probabilities
+            self.extend_vocabulary([so_pair.state for so_pair in so_pairs],
+                                   [so_pair.observation for so_pair in so_pairs])
+            self.extend_arrays()
+        state_indices, observation_indices = self.get_index_vectors(so_pairs)
+        self.train_indices(state_indices, observation_indices, diy, weight, pretrain)
+
+    def _fit_window(self, state_indices, observation_indices, diy, pretrain):
+        # the new probabilities of train_indices, before they are blended with the old ones
         if diy:
             self._init_zeros()
-            self.fit_diy(so_pairs)
+            self.fit_indices(state_indices, observation_indices)
             self.norm()
         else:
             if self.flexible or (self.init == 'zero' and not pretrain):
                 self._init_zeros()
-                self.fit_diy(so_pairs)
+                self.fit_indices(state_indices, observation_indices)
                 self.normalize()
-            obs_index_vector = list(
-                map(lambda x: self.observations.index(x.observation), so_pairs))
-            X = np.array([obs_index_vector]).T
-            self.fit(X)
-        # calculate weighted probabilities from old and new
-        self.startprob_ = self.startprob_ * weight + old_starts * (1 - weight)
-        self.emissionprob_ = self.emissionprob_ * weight + old_emissions * (1 - weight)
-        self.transmat_ = self.transmat_ * weight + old_transmat * (1 - weight)
-        self.normalize()
+            X = np.asarray(observation_indices).reshape(-1, 1)
+            self.fit_budgeted(X)
+
+    def _start_counts(self):
+        # the counts of train_chunks are added to the probabilities, a flexible hmm adds them to buffers
+        self._init_zeros()
+        return None
+
+    def _add_counts(self, buffers, state_indices, observation_indices):
+        # the vocabulary of a flexible hmm grows while the chunks are read, see _reserve
+        if self.flexible:
+            buffers = self._reserve(buffers)
+        self.fit_indices(state_indices, observation_indices)
+        return buffers
+
+    def _finish_counts(self, buffers, old_probabilities):
+        # normalizes the counts of train_chunks and returns the old probabilities in their shape
+        if buffers is not None:
+            # the probabilities do not keep the buffers alive
+            self.startprob_ = self.startprob_.copy()
+            self.transmat_ = self.transmat_.copy()
+            self.emissionprob_ = self.emissionprob_.copy()
+        self.norm()
+        old_starts, old_transmat, old_emissions = old_probabilities
+        if self.flexible:
+            # the old probabilities of the symbols added by the chunks are zero
+            old_starts = self.extend_matrix(np.ravel(old_starts)[np.newaxis], 1, self.n_states)[0]
+            old_transmat = self.extend_matrix(old_transmat, self.n_states, self.n_states)
+            old_emissions = self.extend_matrix(old_emissions, self.n_states, self.n_observations)
+        return old_starts, old_transmat, old_emissions
+
+    def _reserve(self, buffers):
+        """
+        Returns buffers for the start, transition and emission counts of the current vocabulary, the given
+        ones if the vocabulary fits or copies with room for at least twice as many symbols if not, and
+        makes the counts views of them. Adding symbols one file at a time so copies the counts only
+        a logarithmic number of times.
+        """
+        n, m = (0, 0) if buffers is None else buffers[2].shape
+        if buffers is None or n < self.n_states or m < self.n_observations:
+            if n < self.n_states:
+                n = max(self.n_states, 2 * n)
+            if m < self.n_observations:
+                m = max(self.n_observations, 2 * m)
+            starts, transitions, emissions = self.startprob_, self.transmat_, self.emissionprob_
+            buffers = (np.zeros(n), np.zeros((n, n)), np.zeros((n, m)))
+            buffers[0][:len(starts)] = starts
+            buffers[1][:transitions.shape[0], :transitions.shape[1]] = transitions
+            buffers[2][:emissions.shape[0], :emissions.shape[1]] = emissions
+        self.startprob_ = buffers[0][:self.n_states]
+        self.transmat_ = buffers[1][:self.n_states, :self.n_states]
+        self.emissionprob_ = buffers[2][:self.n_states, :self.n_observations]
+        return buffers
+
+    def _blend_matrix(self, new, old, weight):
+        # the weighted probabilities, normalized with smoothing like normalize
+        self._cdfs = None
+        blended = new * weight + old * (1 - weight)
+        blended[blended == 0.0] = 1e-15
+        return self.normalize_1D_array(blended) if blended.ndim == 1 else self.normalize_2D_array(blended)
+
+    def _start_fit(self, X):
+        X = check_array(X)
+        self._init(X)
+        self._check()
+        return X
+
+    def _em_step(self, X):
+        # the same Baum-Welch iteration as fit, returns the log likelihood before it
+        stats = self._initialize_sufficient_statistics()
+        framelogprob = self._compute_log_likelihood(X)
+        logprob, fwdlattice = self._do_forward_pass(framelogprob)
+        bwdlattice = self._do_backward_pass(framelogprob)
+        posteriors = self._compute_posteriors(fwdlattice, bwdlattice)
+        self._accumulate_sufficient_statistics(stats, X, framelogprob, posteriors, fwdlattice, bwdlattice)
+        self._do_mstep(stats)
+        return logprob
+
+    def index_so_pairs(self, so_pairs):
+        """
+        Returns the so_pairs as an (n, 2) array of state and observation indices.
+        Flexible hmms add the new symbols to their vocabulary first, the probabilities are extended by
+        the next training.
+        """
+        if self.flexible:
+            self.extend_vocabulary([so_pair.state for so_pair in so_pairs],
+                                   [so_pair.observation for so_pair in so_pairs])
+        return np.stack(self.get_index_vectors(so_pairs), axis=1)
+
+    def index_symbols(self, states, state_codes, observations, observation_codes):
+        """
+        Returns events like index_so_pairs, given the distinct states and observations of the events and
+        the position of every event's state and observation among them. Only the distinct symbols are
+        looked up, new ones are added to the vocabulary of a flexible hmm in their order.
+        """
+        state_map, observation_map = self.extend_vocabulary(states, observations)
+        return np.stack((state_map[state_codes], observation_map[observation_codes]), axis=1)
 
     def fit_diy(self, so_pairs):
-        previous_chunk = []
-        current_chunk = []
-        for so_pair in so_pairs:
-            current_chunk.append(so_pair)
-            self._sequence_gen(previous_chunk, current_chunk)
-            previous_chunk = current_chunk
-            current_chunk = []
+        state_indices, observation_indices = self.get_index_vectors(so_pairs)
+        self.fit_indices(state_indices, observation_indices)
+
+    def fit_indices(self, state_indices, observation_indices):
+        """
+        Given the state and observation indices of a sequence, this function counts the same
+        starts, emissions and transitions as _sequence_gen does pair by pair, but in one pass:
+        every pair with a successor adds its start and emission and the transition to the successor.
+        """
+        if len(state_indices) < 2:
+            return
+        prev_states = state_indices[:-1]
+        self.startprob_ += np.bincount(prev_states, minlength=self.n_states)
+        self.transmat_ += np.bincount(prev_states * self.n_states + state_indices[1:],
+                                      minlength=self.n_states * self.n_states).reshape(self.n_states, self.n_states)
+        self.emissionprob_ += np.bincount(prev_states * self.n_observations + observation_indices[:-1],
+                                          minlength=self.n_states * self.n_observations).reshape(self.n_states,
+                                                                                                  self.n_observations)
 
     def extend_probabilities(self, so_pair):
-        if so_pair.state not in self.states:
-            self.states.append(so_pair.state)
-            self.startprob_ = np.append(self.startprob_, 0)
-            self.transmat_ = self.extend_matrix(self.transmat_, len(self.states), len(self.states))
-            self.emissionprob_ = self.extend_matrix(self.emissionprob_, len(self.states),
-                                                          len(self.observations))
-            self.n_components = len(self.states)
-            self.n_states = len(self.states)
-        if so_pair.observation not in self.observations:
-            self.observations.append(so_pair.observation)
-            self.emissionprob_ = self.extend_matrix(self.emissionprob_, len(self.states),
-                                                          len(self.observations))
-            self.n_features = len(self.observations)
-            self.n_observations = len(self.observations)
+        self.extend_vocabulary([so_pair.state], [so_pair.observation])
+        self.extend_arrays()
+
+    def extend_vocabulary(self, states, observations):
+        """
+        This function adds the states and observations which are not in the vocabulary yet, in the order
+        they first appear, and returns the indices of all given states and observations as two arrays.
+        The probabilities keep their size, extend_arrays pads them with zeros for the new symbols.
+        """
+        new_states = [state for state in dict.fromkeys(states) if state not in self.state_index]
+        new_observations = [observation for observation in dict.fromkeys(observations)
+                            if observation not in self.observation_index]
+        if new_states or new_observations:
+            if getattr(self, 'shared_index', False):
+                # copy the shared dicts before adding a symbol
+                self.state_index = dict(self.state_index)
+                self.observation_index = dict(self.observation_index)
+                self.shared_index = False
+            for state in new_states:
+                self.state_index[state] = len(self.states)
+                self.states.append(state)
+            for observation in new_observations:
+                self.observation_index[observation] = len(self.observations)
+                self.observations.append(observation)
+            self.n_components = self.n_states = len(self.states)
+            self.n_features = self.n_observations = len(self.observations)
+        return (np.fromiter((self.state_index[state] for state in states), dtype=int, count=len(states)),
+                np.fromiter((self.observation_index[observation] for observation in observations), dtype=int,
+                            count=len(observations)))
+
+    def extend_arrays(self):
+        # pads the probabilities with zeros for the symbols extend_vocabulary added, in one copy
+        if np.shape(self.transmat_) != (self.n_states, self.n_states) or \
+                np.shape(self.emissionprob_) != (self.n_states, self.n_observations):
+            self.startprob_ = self.extend_matrix(np.ravel(self.startprob_)[np.newaxis], 1, self.n_states)[0]
+            self.transmat_ = self.extend_matrix(self.transmat_, self.n_states, self.n_states)
+            self.emissionprob_ = self.extend_matrix(self.emissionprob_, self.n_states, self.n_observations)
 
     @staticmethod
     def extend_matrix(matrix, m, n):
@@ -207,14 +502,76 @@ class HiddenMarkovModel(MultinomialHMM):
             for e2 in current_chunk:
                 self.addTransmat(e1.state, e2.state)
 
+    def _get_cdfs(self):
+        """
+        Returns the cumulative sums of startprob_ and of every row of transmat_ and emissionprob_.
+        The rows are shifted by their index and flattened, so one searchsorted finds the entries
+        of many rows at once. They are cached until the probabilities change.
+        """
+        cdfs = getattr(self, '_cdfs', None)
+        if cdfs is not None and cdfs[0] is self.startprob_ and cdfs[1] is self.transmat_ \
+                and cdfs[2] is self.emissionprob_:
+            return cdfs[3:]
+        # the read-only probabilities of a pretrained model are shared, so are their sums
+        shared = not (self.startprob_.flags.writeable or self.transmat_.flags.writeable
+                      or self.emissionprob_.flags.writeable)
+        key = (id(self.startprob_), id(self.transmat_), id(self.emissionprob_))
+        cdfs = None
+        if shared:
+            with shared_cdfs_lock:
+                cdfs = shared_cdfs.get(key)
+        if cdfs is None or cdfs[0] is not self.startprob_ or cdfs[1] is not self.transmat_ \
+                or cdfs[2] is not self.emissionprob_:
+            start_cdf = np.cumsum(self.startprob_)
+            trans_cdf = (np.cumsum(self.transmat_, axis=1) + np.arange(self.n_states)[:, np.newaxis]).ravel()
+            emission_cdf = (np.cumsum(self.emissionprob_, axis=1) + np.arange(self.n_states)[:, np.newaxis]).ravel()
+            cdfs = (self.startprob_, self.transmat_, self.emissionprob_, start_cdf, trans_cdf, emission_cdf)
+            if shared:
+                with shared_cdfs_lock:
+                    if key not in shared_cdfs and len(shared_cdfs) >= 32:
+                        # forget the oldest model
+                        shared_cdfs.pop(next(iter(shared_cdfs)))
+                    shared_cdfs[key] = cdfs
+        self._cdfs = cdfs
+        return cdfs[3:]
+
+    def sample_indices(self, nr_samples, nr_sequences=1, random_state=None):
+        """
+        Draws nr_sequences sequences of nr_samples states and observations and returns their indices
+        as two arrays of shape (nr_sequences, nr_samples). The uniform numbers are drawn up front in the
+        same order as sample does, so a single sequence equals the one of sample for the same seed.
+        """
+        random_state = check_random_state(random_state if random_state is not None else self.random_state)
+        start_cdf, trans_cdf, emission_cdf = self._get_cdfs()
+        uniforms = random_state.rand(nr_sequences, nr_samples, 2)
+        state_indices = np.empty((nr_sequences, nr_samples), dtype=int)
+        state_indices[:, 0] = np.minimum(start_cdf.searchsorted(uniforms[:, 0, 0], side='right'), self.n_states - 1)
+        last_state = self.n_states - 1
+        for t in range(1, nr_samples):
+            prev_states = state_indices[:, t - 1]
+            next_states = trans_cdf.searchsorted(prev_states + uniforms[:, t, 0], side='right')
+            next_states -= prev_states * self.n_states
+            # rounding may let a row sum up slightly above or below 1, stay in the row anyway
+            np.minimum(np.maximum(next_states, 0, out=next_states), last_state, out=state_indices[:, t])
+        observation_indices = emission_cdf.searchsorted(state_indices + uniforms[:, :, 1], side='right')
+        observation_indices -= state_indices * self.n_observations
+        np.minimum(np.maximum(observation_indices, 0, out=observation_indices), self.n_observations - 1,
+                   out=observation_indices)
+        return state_indices, observation_indices
+
     def get_sample_so_pairs(self, nr_samples):
-        so_pairs = []
-        observation_indices, state_indices = self.sample(nr_samples)
-        for o_index, s_index in enumerate(state_indices):
-            ob = self.observations[observation_indices[o_index][0]]
-            st = self.states[s_index]
-            so_pairs.append(self.serialize(st, ob))
-        return so_pairs
+        return self.get_sample_so_pairs_batch(nr_samples, 1)[0]
+
+    @metrics.timed('hmm_sample')
+    def get_sample_so_pairs_batch(self, nr_samples, nr_sequences):
+        """
+        Returns nr_sequences candidate sequences of nr_samples so_pairs each, drawn in one call.
+        """
+        if nr_samples < 1:
+            return [[] for _ in range(nr_sequences)]
+        state_indices, observation_indices = self.sample_indices(nr_samples, nr_sequences)
+        return [[self.serialize(self.states[s], self.observations[o]) for s, o in zip(states, observations)]
+                for states, observations in zip(state_indices.tolist(), observation_indices.tolist())]
 
     def get_sample_notes(self, nr_sample_notes):
         sample_notes = []
@@ -231,7 +588,7 @@ class HiddenMarkovModel(MultinomialHMM):
 
     def learn_startprob(self, notes):
         for note in notes:
-            itemindex = self.states.index(note.note)
+            itemindex = self.state_index[note.note]
             self.startprob_[itemindex] += 1
         self.startprob_ = self.normalize_1D_array(self.startprob_)
 
@@ -242,24 +599,24 @@ class HiddenMarkovModel(MultinomialHMM):
                 prev = note
             else:
                 curr = note
-                index_prev = self.states.index(prev.note)
-                index_curr = self.states.index(curr.note)
+                index_prev = self.state_index[prev.note]
+                index_curr = self.state_index[curr.note]
                 self.transmat_[index_prev][index_curr] += 1
                 prev = curr
         self.transmat_ = self.normalize_2D_array(self.transmat_)
 
     def addStartprob(self, state):
-        index_prev = self.states.index(state)
+        index_prev = self.state_index[state]
         self.startprob_[index_prev] += 1
 
     def addEmissionprob(self, state, observation):
-        index_prev = self.states.index(state)
-        index_duration = self.observations.index(observation)
+        index_prev = self.state_index[state]
+        index_duration = self.observation_index[observation]
         self.emissionprob_[index_prev][index_duration] += 1
 
     def addTransmat(self, from_state, to_state):
-        index_prev = self.states.index(from_state)
-        index_curr = self.states.index(to_state)
+        index_prev = self.state_index[from_state]
+        index_curr = self.state_index[to_state]
         self.transmat_[index_prev][index_curr] += 1
 
     def normalize(self):
@@ -267,6 +624,7 @@ class HiddenMarkovModel(MultinomialHMM):
         self.norm()
 
     def norm(self):
+        self._cdfs = None
         self.startprob_ = self.normalize_1D_array(self.startprob_)
         self.transmat_ = self.normalize_2D_array(self.transmat_)
         self.emissionprob_ = self.normalize_2D_array(self.emissionprob_)
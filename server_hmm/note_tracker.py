@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# This class handles the pairing of the key events of a player into notes and rests.
+
+import sys
+import time
+
+import pretty_midi
+
+N_KEYS = 128
+
+
+class NoteTracker:
+
+    def __init__(self):
+        """
+        This is the constructor for a NoteTracker, which remembers the time and velocity of every
+        pressed key in one slot per midi pitch. A key up finds its key down in constant time and
+        the memory does not grow however long the session is.
+        """
+        self.down_times = [None] * N_KEYS
+        self.velocities = [0] * N_KEYS
+        # time of the last key up which did not end a rest yet
+        self.last_up = None
+
+    def reset(self):
+        self.down_times = [None] * N_KEYS
+        self.velocities = [0] * N_KEYS
+        self.last_up = None
+
+    def key_down(self, pitch, time, velocity):
+        """
+        Remembers a pressed key and returns the rest since the last released key in seconds,
+        or None if no key was released since the previous rest. Pressing a held key again restarts it.
+        """
+        rest = None
+        if self.last_up is not None:
+            rest = time - self.last_up
+            self.last_up = None
+        if 0 <= pitch < N_KEYS:
+            self.down_times[pitch] = time
+            self.velocities[pitch] = velocity
+        return rest
+
+    def key_up(self, pitch, time):
+        """
+        Returns the duration in seconds and the velocity of the note ended by a released key,
+        or None if the key was not pressed.
+        """
+        self.last_up = time
+        if not 0 <= pitch < N_KEYS:
+            return None
+        start = self.down_times[pitch]
+        if start is None or time <= start:
+            return None
+        self.down_times[pitch] = None
+        return time - start, self.velocities[pitch]
+
+
+def list_pairing(events):
+    # the pairing the socket handlers did before, with lists of key downs and key ups
+    keydown_notes = []
+    keyup_notes = []
+    notes = 0
+    for event_time, is_down, pitch, velocity in events:
+        if is_down:
+            keydown_notes.append([pitch, event_time, velocity])
+            if keyup_notes:
+                notes += 1
+                keyup_notes.clear()
+        else:
+            keyup_notes.append([pitch, event_time])
+            for keydown_note in keydown_notes:
+                key_start = None
+                key_end = None
+                for keyup_note in keyup_notes:
+                    if keydown_note[0] == keyup_note[0] and keyup_note[1] > keydown_note[1]:
+                        key_start = keydown_note[1]
+                        key_end = keyup_note[1]
+                        # the handlers raised here when two key ups matched the same key down
+                        if keydown_note in keydown_notes:
+                            keydown_notes.remove(keydown_note)
+                if key_start and key_end:
+                    notes += 1
+    return notes, len(keydown_notes)
+
+
+def tracker_pairing(events):
+    tracker = NoteTracker()
+    notes = 0
+    for event_time, is_down, pitch, velocity in events:
+        if is_down:
+            if tracker.key_down(pitch, event_time, velocity) is not None:
+                notes += 1
+        elif tracker.key_up(pitch, event_time) is not None:
+            notes += 1
+    return notes, sum(down_time is not None for down_time in tracker.down_times)
+
+
+def read_performance(path, repeats=1):
+    """
+    Returns the key events of a midi file as (time, is_down, pitch, velocity) in playing order,
+    the performance is played repeats times in a row.
+    """
+    midi_data = pretty_midi.PrettyMIDI(path)
+    length = midi_data.get_end_time()
+    events = []
+    for i in range(repeats):
+        offset = i * (length + 1)
+        for instrument in midi_data.instruments:
+            for note in instrument.notes:
+                events.append((offset + note.start, True, note.pitch, note.velocity))
+                events.append((offset + note.end, False, note.pitch, 0))
+    # a key up at the same time as a key down comes first
+    events.sort(key=lambda event: (event[0], event[1]))
+    return events
+
+
+if __name__ == '__main__':
+    # replays a recorded performance through both pairings: python note_tracker.py [midi file] [repeats]
+    path = sys.argv[1] if len(sys.argv) > 1 else 'piano/07_Argpeggien_mit_Pedal.mid'
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    performance = read_performance(path, repeats)
+    print('{} key events'.format(len(performance)))
+    for name, pairing in (('lists', list_pairing), ('note tracker', tracker_pairing)):
+        start = time.perf_counter()
+        nr_notes, nr_held = pairing(performance)
+        seconds = time.perf_counter() - start
+        print('{:>12}: {} notes and rests, {} key downs left, {:.3f}s, {:.2f}us per event'.format(
+            name, nr_notes, nr_held, seconds, seconds / len(performance) * 1e6))
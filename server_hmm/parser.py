@@ -1,11 +1,17 @@
 #!/usr/bin/python
 # This class handles the parsing of a midi data and builds a hidden markov model from it.
 
+import itertools
 import mido
 import numpy as np
 import os
 
 from my_hmm import HiddenMarkovModel
+from sparse_hmm import SparseHiddenMarkovModel
+from corpus_cache import corpus_cache
+from event_encoding import EventEncoding, decode, nearest_indices
+from model_store import model_store
+from metrics import metrics
 from hmmlearn import hmm
 import pretty_midi
 # from music21 import *
@@ -14,7 +20,7 @@ import pretty_midi
 class Parser:
 
     def __init__(self, filenames, verbose=False, time_step=50, end_range=2000, layout='note-time',
-                 init_type='zero', pretrain=True, note_type='midikeys', time_type='ms'):
+                 init_type='zero', pretrain=True, note_type='midikeys', time_type='ms', engine='dense'):
         """
         This is the constructor for a Serializer, which will serialize
         a midi given the filename and generate a hmm of the
@@ -22,6 +28,15 @@ class Parser:
         """
         self.filenames = filenames.strip()
         self.time_step = time_step
+        self.init_type = init_type
+        self.time_type = time_type
+        self.engine = engine
+        # name of the corpus state the hmm was pretrained on, None without pretraining
+        self.corpus = None
+        if engine == 'sparse' and init_type == 'flexible':
+            # the sparse hmm can not extend its vocabulary
+            print('ERROR: the sparse engine does not support the flexible init type, using the dense engine')
+            self.engine = 'dense'
         # The tempo is number representing the number of microseconds
         # per beat.
         self.tempo = 500000
@@ -55,9 +70,53 @@ class Parser:
             states = self.durations
             observations = self.notes
             vice_versa = True
-        self.my_hmm = HiddenMarkovModel(states, observations, init_type, False, vice_versa)
+        if self.engine == 'sparse':
+            self.my_hmm = SparseHiddenMarkovModel(states, observations, init_type, False, vice_versa)
+        else:
+            self.my_hmm = HiddenMarkovModel(states, observations, init_type, False, vice_versa)
+        # flexible hmms have no fixed vocabulary to compute the indices of
+        self.encoding = None if self.my_hmm.flexible else EventEncoding(self.notes, self.durations, self.velocities,
+                                                                          self.note_type, self.layout)
         if pretrain:
+            self.pretrain(verbose)
+
+    def get_config(self):
+        return {
+            'files': os.path.abspath(self.filenames),
+            'time_step': self.time_step,
+            'end_range': self.end_range,
+            'layout': self.layout,
+            'init_type': self.init_type,
+            'note_type': self.note_type,
+            'time_type': self.time_type,
+            'engine': self.engine
+        }
+
+    def pretrain(self, verbose=False):
+        """
+        This function loads the pretrained hmm for this configuration from the model store.
+        If the corpus changed or the model was never trained, it is trained and stored.
+        Random initialised models are not stored, as every session should get its own one.
+        """
+        if not os.path.exists(self.filenames):
+            self.pretty_parse_gen(verbose)
+            return
+        corpus_key = corpus_cache.corpus_key(self.filenames)
+        self.corpus = model_store.corpus_hash(corpus_key)
+        if self.init_type == 'random':
             self.pretty_parse_gen(verbose)
+            return
+        key = model_store.get_key(self.get_config(), corpus_key)
+        params = model_store.load(key)
+        if params is not None:
+            self.my_hmm.set_parameters(params)
+        else:
+            self.pretty_parse_gen(verbose)
+            model_store.save(key, self.my_hmm.get_parameters())
+            # use the shared copy, like the sessions loading it later
+            params = model_store.load(key)
+            if params is not None:
+                self.my_hmm.set_parameters(params)
 
     def get_joint_observations(self):
         obs = []
@@ -91,6 +150,7 @@ class Parser:
                         int(self.tempo), int(self.tempo * 2), int(self.tempo * 4)]
         return [x / 1000 for x in beats_micros]
 
+    @metrics.timed('find_so_pair')
     def find_so_pair(self, note, duration, prev_note=0, velocity=100):
         # get note from midikey
         if note != self.rest:
@@ -121,94 +181,207 @@ class Parser:
 
         return self.my_hmm.serialize(state, obs)
 
+    @metrics.timed('find_event')
+    def find_event(self, note, duration, prev_note=0, velocity=100):
+        """
+        This function returns the state and observation index of the so_pair find_so_pair would return,
+        for hmms with a fixed vocabulary.
+        """
+        return self.encoding.encode_one(note, duration, prev_note, velocity, note == self.rest)
+
+    def find_so_pairs(self, notes, durations, prev_notes, velocities, rests):
+        """
+        This function does the same as find_so_pair for whole arrays of events at once.
+        The durations and velocities are quantised with np.searchsorted instead of a search per note.
+        Events marked in rests are rests, their notes are ignored.
+        """
+        if self.encoding is not None:
+            return decode(self.encoding.encode(notes, durations, prev_notes, velocities, rests), self.my_hmm.states,
+                          self.my_hmm.observations)
+        notes = np.asarray(notes)
+        rests = np.asarray(rests, dtype=bool)
+        # get note from midikey
+        if self.note_type == 'semitones':
+            note_symbols = np.array(self.notes[:-1], dtype=object)[notes % 12]
+        elif self.note_type == 'intervals':
+            note_symbols = notes - prev_notes
+            note_symbols[np.abs(note_symbols) > 12] = 0
+            note_symbols = note_symbols.astype(object)
+        else:
+            note_symbols = notes.astype(object)
+        note_symbols[rests] = self.rest
+        note_symbols = note_symbols.tolist()
+        # flexible hmms bucket the durations
+        durations = self.bucket_durations(durations).tolist()
+        # switch layout
+        if self.layout == 'joint':
+            states = [0] * len(note_symbols)
+            observations = list(zip(note_symbols, durations))
+        elif self.layout == 'velocity-joint':
+            states = np.array(self.velocities)[nearest_indices(self.velocities, velocities)].tolist()
+            observations = list(zip(note_symbols, durations))
+        elif self.layout == 'note-time':
+            states = note_symbols
+            observations = durations
+        elif self.layout == 'time-note':
+            states = durations
+            observations = note_symbols
+
+        return [self.my_hmm.serialize(state, obs) for state, obs in zip(states, observations)]
+
+    def _index_flexible_events(self, notes, durations, prev_notes, velocities, rests):
+        """
+        This function returns the so_pairs of find_so_pairs as state and observation indices of a flexible hmm,
+        see index_so_pairs. The events are grouped by integer keys first, so the symbols are only built and
+        looked up once per distinct key instead of once per event.
+        """
+        if not len(notes):
+            return np.empty((0, 2), dtype=int)
+        notes = np.asarray(notes)
+        rests = np.asarray(rests, dtype=bool)
+        # the key of a note is its symbol, or the position of its name for semitones
+        if self.note_type == 'semitones':
+            note_keys = notes % 12
+            note_keys[rests] = len(self.notes) - 1
+        elif self.note_type == 'intervals':
+            note_keys = notes - prev_notes
+            note_keys[np.abs(note_keys) > 12] = 0
+            note_keys[rests] = self.rest
+        else:
+            note_keys = np.where(rests, self.rest, notes)
+        durations = self.bucket_durations(durations)
+        if self.layout in ('joint', 'velocity-joint'):
+            # one key for a note and a duration, the durations are not negative
+            offset, width = int(note_keys.min()), int(durations.max()) + 1
+            joint_keys, observation_codes = self._first_appearance((note_keys - offset) * width + durations)
+            observations = [(self._note_symbol(key // width + offset), key % width) for key in joint_keys.tolist()]
+            if self.layout == 'joint':
+                states, state_codes = [0], np.zeros(len(notes), dtype=int)
+            else:
+                velocity_keys, state_codes = self._first_appearance(nearest_indices(self.velocities, velocities))
+                states = [self.velocities[key] for key in velocity_keys.tolist()]
+        else:
+            note_keys, note_codes = self._first_appearance(note_keys)
+            notes = [self._note_symbol(note) for note in note_keys.tolist()]
+            durations, duration_codes = self._first_appearance(durations)
+            durations = durations.tolist()
+            if self.layout == 'note-time':
+                states, state_codes, observations, observation_codes = notes, note_codes, durations, duration_codes
+            else:
+                states, state_codes, observations, observation_codes = durations, duration_codes, notes, note_codes
+        return self.my_hmm.index_symbols(states, state_codes, observations, observation_codes)
+
+    def _note_symbol(self, key):
+        return self.notes[key] if self.note_type == 'semitones' else key
+
+    @staticmethod
+    def _first_appearance(keys):
+        # the distinct keys in the order they first appear and the position of every key among them
+        distinct, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        return distinct[order], rank[inverse]
+
+    def _get_file_events(self, events):
+        """
+        Returns the events of a decoded midi file as arrays for find_so_pairs. Every note is followed
+        by its rest, if the rest is between one and four beats long.
+        """
+        n_notes = len(events['pitch'])
+        has_rest = (self.beats[3] <= events['rest']) & (events['rest'] <= self.beats[len(self.beats) - 1])
+        n_rests = np.count_nonzero(has_rest)
+        order = np.argsort(np.concatenate([np.arange(n_notes) * 2, np.flatnonzero(has_rest) * 2 + 1]), kind='stable')
+        prev_notes = np.concatenate([[0], events['pitch'][:-1]])
+        notes = np.concatenate([events['pitch'], np.zeros(n_rests, dtype=int)])[order]
+        durations = np.concatenate([events['duration'], events['rest'][has_rest]])[order]
+        prev_notes = np.concatenate([prev_notes, np.zeros(n_rests, dtype=int)])[order]
+        velocities = np.concatenate([events['velocity'], np.full(n_rests, 100)])[order]
+        rests = np.concatenate([np.zeros(n_notes, dtype=bool), np.ones(n_rests, dtype=bool)])[order]
+        return notes, durations, prev_notes, velocities, rests
+
     def _parse_gen(self, verbose=False):
         """
         This function handles the reading of the midi and parses the notes into state-observation pairs,
         which are used to train the hmm. (mido)
         """
         if os.path.exists(self.filenames):
-            so_pairs = []
-            for filename in os.listdir(self.filenames):
-                if filename.endswith('.mid'):
-                    prev_note = 0
-                    midi = mido.MidiFile(self.filenames + filename)
-                    self.ticks_per_beat = midi.ticks_per_beat
-                    # default MIDI tempo
-                    for track in midi.tracks:
-                        for message in track:
-                            if verbose:
-                                print(message)
-                            if message.type == "set_tempo":
-                                self.tempo = message.tempo
-                                self.beats = self.beats_from_tempo()
-                            # and message.velocity != 0
-                            elif message.type == "note_off":
-                                so_pair = self.find_so_pair(message.note, self._ticks_to_ms(message.time), prev_note)
-                                so_pairs.append(so_pair)
-                                prev_note = message.note
-                            elif message.type == "note_on":
-                                if message.velocity == 0:
-                                    so_pair = self.find_so_pair(message.note, self._ticks_to_ms(message.time),
-                                                                prev_note)
-                                    so_pairs.append(so_pair)
-                                    prev_note = message.note
-                                else:
-                                    duration = self._ticks_to_ms(message.time)
-                                    # if duration in range(self.beats[3], self.beats[len(self.beats) - 1]):
-                                    if self.beats[3] <= duration <= self.beats[len(self.beats) - 1]:
-                                        so_pair = self.find_so_pair(self.rest, self._ticks_to_ms(message.time))
-                                        so_pairs.append(so_pair)
-            if so_pairs:
-                self.my_hmm.train(so_pairs, True)
+            self._train_chunks(self._parse_files(verbose))
         else:
             print('ERROR: not a directory')
             # TODO: send client alert
             return
 
+    def _parse_files(self, verbose=False):
+        # the state-observation pairs of one midi file at a time (mido)
+        for filename in os.listdir(self.filenames):
+            if filename.endswith('.mid'):
+                so_pairs = []
+                prev_note = 0
+                midi = mido.MidiFile(self.filenames + filename)
+                self.ticks_per_beat = midi.ticks_per_beat
+                # default MIDI tempo
+                for track in midi.tracks:
+                    for message in track:
+                        if verbose:
+                            print(message)
+                        if message.type == "set_tempo":
+                            self.tempo = message.tempo
+                            self.beats = self.beats_from_tempo()
+                        # and message.velocity != 0
+                        elif message.type == "note_off":
+                            so_pair = self.find_so_pair(message.note, self._ticks_to_ms(message.time), prev_note)
+                            so_pairs.append(so_pair)
+                            prev_note = message.note
+                        elif message.type == "note_on":
+                            if message.velocity == 0:
+                                so_pair = self.find_so_pair(message.note, self._ticks_to_ms(message.time),
+                                                            prev_note)
+                                so_pairs.append(so_pair)
+                                prev_note = message.note
+                            else:
+                                duration = self._ticks_to_ms(message.time)
+                                # if duration in range(self.beats[3], self.beats[len(self.beats) - 1]):
+                                if self.beats[3] <= duration <= self.beats[len(self.beats) - 1]:
+                                    so_pair = self.find_so_pair(self.rest, self._ticks_to_ms(message.time))
+                                    so_pairs.append(so_pair)
+                if so_pairs:
+                    yield self.my_hmm.index_so_pairs(so_pairs)
+
     def pretty_parse_gen(self, verbose=False):
         """
         This function handles the reading of the midi and parses the notes into state-observation pairs,
         which are used to train the hmm. (pretty_midi)
+        The decoded midi files are shared between all parsers by the corpus cache. The hmm counts
+        the pairs file by file while the later files are decoded, so only one file is parsed at a time.
         """
         if os.path.exists(self.filenames):
-            so_pairs = []
-            for filename in os.listdir(self.filenames):
-                if filename.endswith('.mid'):
-                    prev_note = 0
-                    end = 0
-                    try:
-                        midi_data = pretty_midi.PrettyMIDI(self.filenames + filename)
-                    except:
-                        continue
-                    midi_data.remove_invalid_notes()
-                    for instrument in midi_data.instruments:
-                        # (for jazz midi dataset preprocessing)
-                        # if instrument.program in range(0, 7):
-                        #     print(instrument.name)
-                        #     print(instrument.program)
-                        if not instrument.is_drum:
-                            for note in instrument.notes:
-                                if note.pitch in range(21, 110):
-                                    if verbose:
-                                        print(note)
-                                    pitch = note.pitch
-                                    duration = note.duration * 1000
-                                    so_pair = self.find_so_pair(pitch, duration, prev_note, note.velocity)
-                                    so_pairs.append(so_pair)
-                                    start = note.start
-                                    rest = (start - end) * 1000
-                                    if self.beats[3] <= rest <= self.beats[len(self.beats) - 1]:
-                                        so_pair = self.find_so_pair(self.rest, rest)
-                                        so_pairs.append(so_pair)
-                                    prev_note = pitch
-                                    end = note.end
-            if so_pairs:
-                self.my_hmm.train(so_pairs, True)
+            self._train_chunks(self._pretty_parse_files(verbose))
         else:
             print('ERROR: not a directory')
             # TODO: send client alert
             return
 
+    def _pretty_parse_files(self, verbose=False):
+        # the state and observation indices of one midi file at a time (pretty_midi)
+        for events in corpus_cache.iter(self.filenames):
+            if verbose:
+                print(events)
+            file_events = self._get_file_events(events)
+            if self.encoding is not None:
+                chunk = self.encoding.encode(*file_events)
+            else:
+                # flexible hmms add the new symbols of the file to their vocabulary
+                chunk = self._index_flexible_events(*file_events)
+            if len(chunk):
+                yield chunk
+
+    def _train_chunks(self, chunks):
+        # trains only if there is an event at all, like training on the list of all pairs did
+        first = next(chunks, None)
+        if first is not None:
+            self.my_hmm.train_chunks(itertools.chain([first], chunks))
+
     def _ticks_to_ms(self, ticks):
         try:
             return ((ticks / self.ticks_per_beat) * self.tempo) / 1000
@@ -227,6 +400,13 @@ class Parser:
         else:
             return self._round_down(ms)
 
+    def bucket_durations(self, ms):
+        """
+        This method does the same as bucket_duration for an array of milliseconds.
+        """
+        modulo_ms = np.mod(ms, self.time_step)
+        return np.where(modulo_ms >= self.time_step / 2, ms - modulo_ms + self.time_step, ms - modulo_ms).astype(int)
+
     def _round_up(self, ms):
         return int(ms - (ms % self.time_step) + self.time_step)
 
@@ -265,6 +445,8 @@ if __name__ == "__main__":
     hmm.print_2D_array(hmm.emissionprob_)
 
     hmm._check()
+    # the pretrained probabilities are shared read-only
+    hmm.set_emissionprob(np.array(hmm.emissionprob_))
     for i in range(len(hmm.observations)):
         swap = i + np.argmin(hmm.observations[i:])
         (hmm.observations[i], hmm.observations[swap]) = (hmm.observations[swap], hmm.observations[i])
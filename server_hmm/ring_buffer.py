@@ -0,0 +1,47 @@
+#!/usr/bin/python
+# This class handles a fixed size history of integer rows.
+
+import numpy as np
+
+
+class RingBuffer:
+
+    def __init__(self, capacity, width=1, dtype=int):
+        """
+        This is the constructor for a RingBuffer, which keeps the newest capacity rows of width integers.
+        Every row is written twice, capacity rows apart, so the newest rows are always
+        a contiguous part of the array and window returns them without copying.
+        """
+        self.capacity = max(int(capacity), 1)
+        self.data = np.zeros((2 * self.capacity, width), dtype=dtype)
+        # index of the next row to write
+        self.position = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, row):
+        self.data[self.position] = row
+        self.data[self.position + self.capacity] = row
+        self.position = (self.position + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def window(self, n=None):
+        """
+        Returns a view of the newest n rows, oldest first. The view changes when rows are appended.
+        """
+        n = self.size if n is None else min(n, self.size)
+        end = self.position + self.capacity
+        return self.data[end - n:end]
+
+    def clear(self):
+        self.position = 0
+        self.size = 0
+
+    def resize(self, capacity):
+        # keeps the newest rows which fit
+        rows = self.window(capacity).copy()
+        self.__init__(capacity, self.data.shape[1], self.data.dtype)
+        for row in rows:
+            self.append(row)
@@ -1,46 +1,215 @@
 import os
-from flask import send_file
+# the message queue of several workers needs cooperative sockets, training runs in the native threads of gevent
+if os.environ.get('HMM_MESSAGE_QUEUE'):
+    from gevent import monkey
+    monkey.patch_all(thread=False)
+from flask import send_file, abort, Response
 from flask_socketio import SocketIO
 import time
 import json
 from flask import Flask, request
 from flask_cors import CORS
 from hmm_handler import HMMHandler
-import pickle
-import socket
-import sys
+from corpus_cache import corpus_cache
+from catalogue import ModelCatalogue
+from beat_clock import BeatClock
+from note_tracker import NoteTracker
+from session_store import SessionStore, patch_arrays
+from metrics import metrics
+import model_io
+import gevent
+import logging
 # from generator import Generator
 
 UDP_IP = "127.0.0.1"
 UDP_PORT = 9001
+# directory of the hmms saved by the players
+SAVE_PATH = 'saved/'
+# number of saved hmms sent to a client at once
+HMM_LIST_PAGE = 50
+# worker processes for decoding the midi corpus
+CORPUS_WORKERS = os.cpu_count() or 1
+# retrain the hmms in background threads instead of the socket handlers
+ASYNC_TRAINING = True
+# limits of a single live retraining: Baum-Welch iterations, log likelihood tolerance and seconds
+TRAIN_ITERATIONS = 100
+TRAIN_TOLERANCE = 1e-2
+TRAIN_BUDGET = 0.25
+# sample the next melody while the player fills the window, so the trigger only sends it
+SPECULATIVE_SAMPLING = True
+# redis urls of the socket.io message queue and the session store shared by several workers,
+# without them there is one worker which keeps its sessions in memory
+MESSAGE_QUEUE = os.environ.get('HMM_MESSAGE_QUEUE')
+SESSION_STORE = os.environ.get('HMM_SESSION_STORE')
+# seconds a session can be recovered after its last change
+SESSION_TTL = 24 * 60 * 60
+# seconds between two writes of the trained probabilities of a session, the last ones are written on disconnect
+SESSION_OVERLAY_INTERVAL = 30
+# seconds between two writes of the sessions which played a melody since their last write
+SESSION_STORE_INTERVAL = 10
+# DEBUG logs every note, the levels above do not format anything on the hot path
+LOG_LEVEL = os.environ.get('HMM_LOG_LEVEL', 'WARNING')
+# clients allowed to read the latency histograms at /metrics
+METRICS_CLIENTS = ('127.0.0.1', '::1')
+
+logging.basicConfig(level=LOG_LEVEL)
 
 app = Flask(__name__, static_url_path='', static_folder=os.path.abspath('../static'))
 CORS(app)
 app.config['SECRET_KEY'] = 'secret!'
-socketio = SocketIO(app, async_mode="gevent")
+socketio = SocketIO(app, async_mode="gevent", message_queue=MESSAGE_QUEUE)
 socketio.init_app(app, cors_allowed_origins="*")
-thread = None
+beat_clock = BeatClock(UDP_IP, UDP_PORT)
+corpus_cache.workers = CORPUS_WORKERS
+os.makedirs(SAVE_PATH, exist_ok=True)
+catalogue = ModelCatalogue(SAVE_PATH + 'catalogue.sqlite')
+catalogue.sync(SAVE_PATH)
+session_store = SessionStore.from_url(SESSION_STORE, SESSION_TTL)
 # generator = Generator()
 
 cache = {}
 
+
+def new_hmm_handler(*args, **kwargs):
+    return HMMHandler(*args, train_async=ASYNC_TRAINING, n_iter=TRAIN_ITERATIONS, tol=TRAIN_TOLERANCE,
+                      train_budget=TRAIN_BUDGET, speculative=SPECULATIVE_SAMPLING, **kwargs)
+
+
+def load_hmm_handler(name):
+    header, arrays = model_io.load(SAVE_PATH + name + model_io.EXTENSION)
+    hmm_handler = restore_hmm_handler(header, arrays)
+    hmm_handler.saved_name = name
+    return hmm_handler
+
+
+def restore_hmm_handler(header, arrays):
+    return HMMHandler.from_saved_model(header, arrays, train_async=ASYNC_TRAINING, n_iter=TRAIN_ITERATIONS,
+                                       tol=TRAIN_TOLERANCE, train_budget=TRAIN_BUDGET,
+                                       speculative=SPECULATIVE_SAMPLING)
+
+
+def recover_hmm_handler(state, overlay):
+    """
+    Creates the handler of a session from the session store: from the saved hmm it was loaded from or
+    from its config, with the probabilities of its overlay if it has trained ones. The overlay only
+    holds the changes to the probabilities of that handler, unless they were random.
+    """
+    recovered = overlay is not None and overlay[0].get('overlay_id') == state.get('overlay_id')
+    hmm_handler = None
+    if state['saved_name'] is not None:
+        hmm_handler = load_hmm_handler(state['saved_name'])
+    elif not recovered or state['config']['init_type'] != 'random':
+        hmm_handler = new_hmm_handler(**state['config'])
+    if recovered:
+        header, arrays = overlay
+        base_arrays = None if hmm_handler is None else hmm_handler.base_arrays
+        hmm_handler = restore_hmm_handler(header, patch_arrays(arrays, base_arrays))
+        hmm_handler.saved_name = state['saved_name']
+        hmm_handler.base_arrays = base_arrays
+    hmm_handler.restore_state(state)
+    return hmm_handler
+
+
+def store_session(sid, final=False):
+    """
+    Writes the state of a session every time and its probabilities when they changed since the last time,
+    but at most every SESSION_OVERLAY_INTERVAL seconds while the session plays with the same handler.
+    A final store, on disconnect, writes the newest probabilities.
+    """
+    session = cache[sid]
+    session['dirty'] = False
+    hmm_handler = session['hmm_handler']
+    state = hmm_handler.get_state()
+    overlay = None
+    version = (hmm_handler, hmm_handler.model_version)
+    if session['overlay_version'] != version:
+        same_handler = session['overlay_version'] is not None and session['overlay_version'][0] is hmm_handler
+        if not same_handler or final or time.time() - session['overlay_time'] >= SESSION_OVERLAY_INTERVAL:
+            overlay = hmm_handler.get_overlay()
+            session['overlay_version'] = version
+            session['overlay_id'] = None
+            if overlay is not None:
+                session['overlay_id'] = SessionStore.new_token()
+                session['overlay_time'] = time.time()
+    state['overlay_id'] = session['overlay_id']
+    try:
+        run_in_thread(write_session, session['token'], state, overlay, hmm_handler.base_arrays)
+    except Exception as e:
+        print('ERROR: could not store session ' + session['token'])
+        print(e)
+
+
+def store_dirty_sessions():
+    # melodies do not wait for the session store, the sessions they changed are written every few seconds
+    while True:
+        gevent.sleep(SESSION_STORE_INTERVAL)
+        for sid in [sid for sid, session in list(cache.items()) if session['dirty']]:
+            # a session may disconnect while the others are written
+            if sid in cache:
+                store_session(sid)
+
+
+def write_session(token, state, overlay, base_arrays):
+    if overlay is not None:
+        header, arrays = overlay
+        session_store.save_overlay(token, dict(header, overlay_id=state['overlay_id']), arrays, base_arrays)
+    session_store.save_state(token, state)
+
+
+def save_hmm(path, name, header, arrays):
+    model_io.dump(path, header, arrays)
+    catalogue.add(name, header['config'], os.path.getsize(path), header['corpus'])
+
+
+def run_in_thread(function, *args):
+    # file io runs in a real thread, only the calling greenlet waits for it
+    return gevent.get_hub().threadpool.spawn(function, *args).get()
+
+
 @socketio.on('message')
 def handle_message(message):
-    print('received message: ' + message)
+    logging.debug('received message: %s', message)
 
 
 @socketio.on('connect')
 def handle_connect():
+    # a client reconnecting with its token, after a restart or on another worker, gets its session back
     sid = request.sid
-    cache[sid] = {'keyup_notes': [], 'keydown_notes': [], 'hmm_handler': HMMHandler(), 'hmm_list': []}
-    update_hmm_list(sid)
-    socketio.emit('setHmmList', cache[sid]['hmm_list'], room=sid)
+    token = request.args.get('token')
+    hmm_handler = None
+    if token:
+        try:
+            state, overlay = run_in_thread(session_store.load, token)
+            if state is not None:
+                hmm_handler = run_in_thread(recover_hmm_handler, state, overlay)
+        except Exception as e:
+            print('ERROR: could not recover session ' + token)
+            print(e)
+    cache[sid] = {'token': token, 'note_tracker': NoteTracker(), 'overlay_version': None, 'overlay_id': None,
+                  'overlay_time': 0, 'dirty': False}
+    if hmm_handler is None:
+        cache[sid]['token'] = SessionStore.new_token()
+        cache[sid]['hmm_handler'] = new_hmm_handler()
+    else:
+        cache[sid]['hmm_handler'] = hmm_handler
+        # an overlay which was recovered does not have to be written again
+        cache[sid]['overlay_version'] = (hmm_handler, hmm_handler.model_version)
+        cache[sid]['overlay_id'] = state.get('overlay_id')
+    socketio.emit('sessionToken', cache[sid]['token'], room=sid)
+    send_hmm_list(sid)
+    if hmm_handler is not None:
+        update_beat_subscription(sid)
+        send_ui_config(sid)
+    store_session(sid)
 
 
 @socketio.on('disconnect')
 def handle_disconnect():
     sid = request.sid
+    beat_clock.unsubscribe(sid)
+    store_session(sid, final=True)
     cache.pop(sid)
+    metrics.drop_session(sid)
     # path = 'pickle/' + sid + '/'
     # if os.path.exists(path):
     #     shutil.rmtree(path)
@@ -50,31 +219,49 @@ def handle_disconnect():
 def handle_save(filename):
     sid = request.sid
     ts = time.gmtime()
-    hmm_name = filename + time.strftime("%Y%m%d%H%M%S", ts)
-    path = 'pickle/'
+    hmm_name = os.path.basename(filename) + time.strftime("%Y%m%d%H%M%S", ts)
     # path = 'pickle/' + sid + '/'
     # os.mkdir(path)
-    fn = path + hmm_name + '.pkl'
-    with open(fn, "wb") as file:
-        pickle.dump(cache[sid]['hmm_handler'], file)
-        file.close()
-    update_hmm_list(sid)
+    fn = SAVE_PATH + hmm_name + model_io.EXTENSION
+    # the arrays are replaced, not changed, by training, so the snapshot stays valid while it is written
+    header, arrays = cache[sid]['hmm_handler'].get_saved_model()
+    run_in_thread(save_hmm, fn, hmm_name, header, arrays)
     socketio.emit('updateHmmList', hmm_name, room=sid)
 
 
+@socketio.on('queryHmmList')
+def handle_query_hmm_list(json_string):
+    # one page of the saved hmms, filtered by a part of the name and the layout
+    json_object = json.loads(json_string) if json_string else {}
+    send_hmm_list(request.sid, int(json_object.get('offset', 0)), int(json_object.get('limit', HMM_LIST_PAGE)),
+                  json_object.get('search'), json_object.get('layout'))
+
+
+def send_hmm_list(sid, offset=0, limit=HMM_LIST_PAGE, search=None, layout=None):
+    # the client asks for the next pages with queryHmmList
+    total, models = catalogue.query(offset, min(limit, HMM_LIST_PAGE), search, layout)
+    socketio.emit('hmmList', {'total': total, 'offset': offset, 'models': models}, room=sid)
+
+
 @socketio.on('changeHMM')
 def handle_change(filename):
     sid = request.sid
     if filename != 'new':
         # with open('pickle/' + sid + '/' + filename + ".pkl", "rb") as file:
-        with open('pickle/' + filename + ".pkl", "rb") as file:
-            cache[sid]['hmm_handler'] = pickle.load(file)
-            file.close()
-            global thread
-            if cache[sid]['hmm_handler'].triggering == 'beat-based':
-                thread = socketio.start_background_task(background_thread, sid)
+        try:
+            cache[sid]['hmm_handler'] = run_in_thread(load_hmm_handler, os.path.basename(filename))
+        except (OSError, ValueError, KeyError) as e:
+            print('ERROR: could not load ' + filename)
+            print(e)
+            return
     else:
-        cache[sid]['hmm_handler'] = HMMHandler()
+        cache[sid]['hmm_handler'] = new_hmm_handler()
+    update_beat_subscription(sid)
+    send_ui_config(sid)
+    store_session(sid)
+
+
+def send_ui_config(sid):
     hmm_handler = cache[sid]['hmm_handler']
     ui_config = {
         'init': hmm_handler.init_type,
@@ -101,8 +288,8 @@ def handle_update(json_string):
     sid = request.sid
     json_object = json.loads(json_string)
     hmm_handler = cache[sid]['hmm_handler']
-    hmm_handler.train_vector = []
-    hmm_handler.obs_vector = []
+    hmm_handler.train_count = 0
+    hmm_handler.obs_count = 0
     hmm_handler.train = True if json_object['retrain'] == 'yes' else False
     hmm_handler.sample_rate = int(json_object['sample-rate'])
     hmm_handler.nr_samples = int(json_object['nr-samples'])
@@ -111,10 +298,9 @@ def handle_update(json_string):
     hmm_handler.train_rate = int(json_object['train-rate'])
     hmm_handler.weighting = int(json_object['weighting'])
     hmm_handler.triggering = json_object['triggering']
-    global thread
-    if hmm_handler.triggering == 'beat-based':
-        thread = socketio.start_background_task(background_thread, sid)
     cache[sid]['hmm_handler'] = hmm_handler
+    update_beat_subscription(sid)
+    store_session(sid)
 
 
 @socketio.on('submit')
@@ -136,13 +322,14 @@ def handle_submit(json_string):
     files = json_object['files']
     pretrain = True if json_object['pretrain'] == 'yes' else False
     triggering = json_object['triggering']
-    cache[sid]['hmm_handler'] = HMMHandler(retrain, sample_rate, nr_samples, window_size, quantisation, layout,
-                                                   train_diy, train_rate, files, init_type, pretrain, weighting, note_type, time_type, triggering)
-    global thread
-    if triggering == 'beat-based':
-        thread = socketio.start_background_task(background_thread, sid)
-    cache[sid]['keyup_notes'].clear()
-    cache[sid]['keydown_notes'].clear()
+    # the sparse engine keeps large vocabularies small in memory, older clients do not send it
+    engine = json_object.get('engine', 'dense')
+    cache[sid]['hmm_handler'] = new_hmm_handler(retrain, sample_rate, nr_samples, window_size, quantisation, layout,
+                                                train_diy, train_rate, files, init_type, pretrain, weighting, note_type,
+                                                time_type, triggering, engine=engine)
+    update_beat_subscription(sid)
+    cache[sid]['note_tracker'].reset()
+    store_session(sid)
 
 
 # @socketio.on('savemidi')
@@ -154,70 +341,80 @@ def handle_submit(json_string):
 @socketio.on('keydown')
 def handle_keydown(content):
     sid = request.sid
-    cache[sid]['keydown_notes'].append([content['note'], time.time(), content['velocity']])
-    if cache[sid]['keyup_notes']:
-        keyup = cache[sid]['keyup_notes'][-1]
-        keydown = cache[sid]['keydown_notes'][-1]
-        start_time = keyup[1]
-        end_time = keydown[1]
-        duration = end_time - start_time
+    metrics.count(sid, 'key_events')
+    duration = cache[sid]['note_tracker'].key_down(content['note'], time.time(), content['velocity'])
+    if duration is not None:
         rest = cache[sid]['hmm_handler'].parser.rest
         generated_sequence = cache[sid]['hmm_handler'].call(rest, duration)
         if generated_sequence:
-            socketio.emit('predicted-melody', generated_sequence, room=sid)
-        cache[sid]['keyup_notes'].clear()
+            send_melody(sid, generated_sequence)
+            return True
+    return False
 
 
 @socketio.on('keyup')
 def handle_keyup(content):
     sid = request.sid
-    cache[sid]['keyup_notes'].append([content['note'], time.time()])
-    for keydown_note in cache[sid]['keydown_notes']:
-        key_start = None
-        key_end = None
-
-        # find matching keyup event
-        for keyup_note in cache[sid]['keyup_notes']:
-            if keydown_note[0] == keyup_note[0] and keyup_note[1] > keydown_note[1]:
-                key_start = keydown_note[1]
-                key_end = keyup_note[1]
-                cache[sid]['keydown_notes'].remove(keydown_note)
-
-        if key_start and key_end:
-            note = keydown_note[0]
-            duration = key_end - key_start
-            velocity = keydown_note[2]
-            generated_sequence = cache[sid]['hmm_handler'].call(note, duration, velocity)
-            if generated_sequence:
-                socketio.emit('predicted-melody', generated_sequence, room=sid)
-
-
-def background_thread(sid):
-    print('start thread')
-    sock = socket.socket(socket.AF_INET,  # Internet
-                         socket.SOCK_DGRAM)  # UDP
-    sock.bind((UDP_IP, UDP_PORT))
-    sock.setblocking(False)
-    print(cache[sid]['hmm_handler'].triggering)
-    while cache[sid]['hmm_handler'].triggering == 'beat-based':
-        try:
-            data = sock.recv(2)  # buffer size is 1024 bytes
-            print(data)
-            generated_sequence = cache[sid]['hmm_handler'].call_beat()
-            if generated_sequence:
-                socketio.emit('predicted-melody', generated_sequence, room=sid)
-
-            socketio.sleep(0)
-        except socket.error as e:
-            err = e.args[0]
-            if err == 35:
-                socketio.sleep(1)
-                # print('No data available')
-                continue
-            else:
-                # a "real" error occurred
-                print(e)
-                sys.exit(1)
+    metrics.count(sid, 'key_events')
+    note = cache[sid]['note_tracker'].key_up(content['note'], time.time())
+    if note is not None:
+        duration, velocity = note
+        generated_sequence = cache[sid]['hmm_handler'].call(content['note'], duration, velocity)
+        if generated_sequence:
+            send_melody(sid, generated_sequence)
+            return True
+    return False
+
+
+@socketio.on('noteEvents')
+def handle_note_events(events):
+    # a batch of key events [{'type': 'down' or 'up', 'note', 'velocity', 'time'}] from a midi keyboard,
+    # timed by the client in milliseconds. Clients sending batches should send all their key events this way,
+    # the server clock of keydown and keyup does not match the client clock.
+    # Like keydown and keyup, it acknowledges whether it triggered a melody to clients asking for it.
+    sid = request.sid
+    metrics.count(sid, 'key_events', len(events))
+    note_tracker = cache[sid]['note_tracker']
+    hmm_handler = cache[sid]['hmm_handler']
+    notes = []
+    for event in sorted(events, key=lambda e: e['time']):
+        event_time = event['time'] / 1000
+        if event['type'] == 'down':
+            duration = note_tracker.key_down(event['note'], event_time, event.get('velocity', 100))
+            if duration is not None:
+                notes.append((hmm_handler.parser.rest, duration, 100))
+        else:
+            note = note_tracker.key_up(event['note'], event_time)
+            if note is not None:
+                notes.append((event['note'],) + note)
+    generated_sequence = hmm_handler.call_batch(notes)
+    if generated_sequence:
+        send_melody(sid, generated_sequence)
+        return True
+    return False
+
+
+def update_beat_subscription(sid):
+    # beat-based sessions get every beat of the shared clock
+    if cache[sid]['hmm_handler'].triggering == 'beat-based':
+        beat_clock.subscribe(sid, lambda data: handle_beat(sid))
+    else:
+        beat_clock.unsubscribe(sid)
+
+
+def handle_beat(sid):
+    metrics.count(sid, 'beats')
+    generated_sequence = cache[sid]['hmm_handler'].call_beat()
+    if generated_sequence:
+        send_melody(sid, generated_sequence)
+
+
+def send_melody(sid, generated_sequence):
+    metrics.count(sid, 'melodies')
+    with metrics.timer('emit'):
+        socketio.emit('predicted-melody', generated_sequence, room=sid)
+    # a melody ends a part of the session worth recovering
+    cache[sid]['dirty'] = True
 
 
 @app.route('/', methods=['GET', 'POST'])
@@ -225,12 +422,15 @@ def index():
     return send_file('../static/index.html')
 
 
-def update_hmm_list(sid):
-    cache[sid]['hmm_list'] = []
-    # for filename in os.listdir('pickle/' + sid + '/'):
-    for filename in os.listdir('pickle/'):
-        cache[sid]['hmm_list'].append(os.path.splitext(filename)[0])
+@app.route('/metrics')
+def export_metrics():
+    # the stage histograms and session counters for a local prometheus
+    if request.remote_addr not in METRICS_CLIENTS:
+        abort(403)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 
+session_writer = gevent.spawn(store_dirty_sessions)
 
 if __name__ == '__main__':
     socketio.run(app, host='0.0.0.0', port=8080)
@@ -0,0 +1,217 @@
+#!/usr/bin/python
+# This class handles the state of the sessions which outlives a worker process.
+
+import json
+import secrets
+import threading
+import time
+import warnings
+
+import numpy as np
+
+import model_io
+
+PREFIX = 'hmm-session:'
+# bytes of values a MemoryBackend keeps at most, the oldest values are dropped first
+MEMORY_LIMIT = 256 * 1024 * 1024
+# relative error of the entries diff_arrays stores as a factor of the old ones
+OVERLAY_TOLERANCE = 1e-12
+
+
+class MemoryBackend:
+
+    def __init__(self, max_bytes=MEMORY_LIMIT):
+        """
+        This is the constructor for a MemoryBackend, which keeps the values in a dict of this process.
+        It is the default for a single worker, a restarted worker starts without sessions.
+        The values are kept in the order they were written. Every set drops the expired values at the
+        front, and the oldest values while all of them take more than max_bytes, so the sessions nobody
+        reconnects to do not stay in memory.
+        """
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        # key -> (time of expiry, value), oldest first
+        self.values = {}
+        self.size = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                self._drop(key)
+                return None
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            # a written value moves to the end
+            self._drop(key)
+            self.values[key] = (time.time() + ttl, value)
+            self.size += len(value)
+            self._purge()
+
+    def delete(self, key):
+        with self.lock:
+            self._drop(key)
+
+    def _drop(self, key):
+        entry = self.values.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def _purge(self):
+        # the store writes every value with the same ttl, so the values expire in the order they were written
+        now = time.time()
+        while self.values:
+            key, (expiry, value) = next(iter(self.values.items()))
+            if expiry >= now and self.size <= self.max_bytes:
+                break
+            self._drop(key)
+
+
+class RedisBackend:
+
+    def __init__(self, client):
+        """
+        This is the constructor for a RedisBackend, which keeps the values in a redis server shared by
+        all workers. Any client with the get, set and delete of redis-py works, like a local stand-in.
+        """
+        self.client = client
+
+    @classmethod
+    def from_url(cls, url):
+        # redis is only needed when the sessions are shared between workers
+        import redis
+        return cls(redis.Redis.from_url(url))
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value, ttl):
+        self.client.set(key, value, ex=int(ttl))
+
+    def delete(self, key):
+        self.client.delete(key)
+
+
+class SessionStore:
+
+    def __init__(self, backend=None, ttl=24 * 60 * 60):
+        """
+        This is the constructor for a SessionStore, which keeps the state of every session under a token
+        the client reconnects with. The small state (the config, counters and training window) is written
+        often, the probabilities only when the session changed them, as an overlay of the model the
+        session started from. The overlay only holds the changes to that model, see diff_arrays. Sessions expire ttl seconds after their last change.
+        """
+        self.backend = MemoryBackend() if backend is None else backend
+        self.ttl = ttl
+
+    @classmethod
+    def from_url(cls, url, ttl=24 * 60 * 60):
+        """
+        Returns a store for a redis url, or one in memory if url is empty or redis can not be used.
+        """
+        if not url:
+            return cls(ttl=ttl)
+        try:
+            return cls(RedisBackend.from_url(url), ttl)
+        except ImportError as e:
+            print('ERROR: can not share the sessions, redis is not installed')
+            print(e)
+            return cls(ttl=ttl)
+
+    @staticmethod
+    def new_token():
+        return secrets.token_urlsafe(16)
+
+    def save_state(self, token, state):
+        self.backend.set(PREFIX + token + ':state', json.dumps(state, default=model_io.to_json), self.ttl)
+
+    def save_overlay(self, token, header, arrays, base=None):
+        self.backend.set(PREFIX + token + ':overlay', model_io.dumps(header, diff_arrays(arrays, base)), self.ttl)
+
+    def load(self, token):
+        """
+        Returns the state and the overlay (header and arrays) of a session, None for what is missing.
+        """
+        state = self.backend.get(PREFIX + token + ':state')
+        if state is None:
+            return None, None
+        overlay = self.backend.get(PREFIX + token + ':overlay')
+        if overlay is not None:
+            try:
+                overlay = model_io.loads(overlay, 'overlay of session ' + token)
+            except ValueError as e:
+                print('ERROR: dropped the overlay of session ' + token)
+                print(e)
+                overlay = None
+        return json.loads(state), overlay
+
+    def delete(self, token):
+        self.backend.delete(PREFIX + token + ':state')
+        self.backend.delete(PREFIX + token + ':overlay')
+
+
+def diff_arrays(arrays, base):
+    """
+    Returns the arrays as changes to the arrays of the same name in base. Training blends the old
+    probabilities with new ones which are mostly zero, so a row of a trained array is mostly its old
+    row times a factor. The change is stored as these factors, name + '.scale', and the flat indices
+    and values of the entries which are not, name + '.index' and name + '.values'. An array whose
+    shape changed, or which would not get smaller, is returned as it is.
+    """
+    if base is None:
+        return arrays
+    diff = {}
+    for name, array in arrays.items():
+        array = np.asarray(array)
+        base_array = base.get(name)
+        if base_array is None or np.shape(base_array) != array.shape or base_array.dtype != array.dtype \
+                or not array.size:
+            diff[name] = array
+            continue
+        rows = array.reshape(len(array) if array.ndim > 1 else 1, -1)
+        base_rows = np.asarray(base_array).reshape(rows.shape)
+        scale = None
+        if np.issubdtype(array.dtype, np.floating):
+            with np.errstate(divide='ignore', invalid='ignore'), warnings.catch_warnings():
+                # rows without an entry to compare keep their scale of one
+                warnings.simplefilter('ignore', RuntimeWarning)
+                scale = np.nanmedian(np.where(base_rows != 0, rows / base_rows, np.nan), axis=1)
+            scale = np.nan_to_num(scale, nan=1.0, posinf=1.0, neginf=1.0)
+            with np.errstate(invalid='ignore', over='ignore'):
+                index = np.flatnonzero(~(np.abs(base_rows * scale[:, np.newaxis] - rows)
+                                         <= OVERLAY_TOLERANCE * np.abs(rows)))
+        else:
+            index = np.flatnonzero(rows != base_rows)
+        index = index.astype(np.int32)
+        size = index.nbytes + index.size * array.itemsize + (0 if scale is None else scale.nbytes)
+        if size >= array.nbytes:
+            diff[name] = array
+            continue
+        if scale is not None:
+            diff[name + '.scale'] = scale
+        diff[name + '.index'] = index
+        diff[name + '.values'] = array.ravel()[index]
+    return diff
+
+
+def patch_arrays(diff, base):
+    """
+    Returns the arrays of diff_arrays, built again from the arrays in base.
+    """
+    arrays = {}
+    for name, array in diff.items():
+        if name.endswith('.index'):
+            name = name[:-len('.index')]
+            base_array = np.asarray(base[name])
+            rows = base_array.reshape(len(base_array) if base_array.ndim > 1 else 1, -1)
+            scale = diff.get(name + '.scale')
+            patched = np.array(rows) if scale is None else rows * scale[:, np.newaxis]
+            patched.flat[array] = diff[name + '.values']
+            arrays[name] = patched.reshape(base_array.shape)
+        elif not name.endswith('.values') and not name.endswith('.scale'):
+            arrays[name] = array
+    return arrays
@@ -0,0 +1,432 @@
+#!/usr/bin/python
+# This class handles the storage and manipulation of a hmm with sparse probabilities in log space.
+import copy
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.special import logsumexp
+from sklearn.utils import check_random_state
+
+from metrics import metrics
+from my_hmm import HmmTraining, SOPair, symbol_index
+
+# probability replace_zeros gives to a zero entry before normalizing
+SMOOTHING = 1e-15
+
+
+class LogSparseMatrix:
+
+    def __init__(self, log_floor, log_values):
+        """
+        This is the constructor for a LogSparseMatrix, a row stochastic matrix in log space.
+        The entries of the support are stored in the csr matrix log_values,
+        every other entry of row i has the log probability log_floor[i].
+        """
+        self.log_floor = log_floor
+        self.log_values = log_values
+        self.shape = log_values.shape
+        self._excess = None
+        self._columns = None
+        self._cdf = None
+        self._gaps = None
+
+    @classmethod
+    def zeros(cls, n_rows, n_cols):
+        return cls(np.full(n_rows, -np.inf), sp.csr_matrix((n_rows, n_cols)))
+
+    @classmethod
+    def from_weights(cls, floor, values, smoothing=True):
+        """
+        Returns the row normalized matrix of non negative weights, given as the csr matrix values
+        on the support and the weight floor[i] for every other entry of row i.
+        With smoothing, zero weights are replaced like replace_zeros does before normalizing,
+        without it zero weights stay zero and rows of zeros stay zero like in norm.
+        """
+        values = sp.csr_matrix(values)
+        values.sum_duplicates()
+        values.eliminate_zeros()
+        n_rows, n_cols = values.shape
+        floor = np.array(floor, dtype=float)
+        if smoothing:
+            floor[floor == 0] = SMOOTHING
+        nnz = np.diff(values.indptr)
+        totals = floor * (n_cols - nnz) + np.asarray(values.sum(axis=1)).ravel()
+        with np.errstate(divide='ignore'):
+            log_totals = np.log(np.where(totals > 0, totals, 1))
+            log_floor = np.log(floor) - log_totals
+        rows = np.repeat(np.arange(n_rows), nnz)
+        log_values = sp.csr_matrix((np.log(values.data) - log_totals[rows], values.indices, values.indptr),
+                                   shape=values.shape)
+        return cls(log_floor, log_values)
+
+    def _rows(self):
+        return np.repeat(np.arange(self.shape[0]), np.diff(self.log_values.indptr))
+
+    def floor(self):
+        return np.exp(self.log_floor)
+
+    def excess(self):
+        """
+        Returns the probabilities of the support minus the floor of their row as linear csr matrix.
+        """
+        if self._excess is None:
+            data = np.clip(np.exp(self.log_values.data) - np.exp(self.log_floor[self._rows()]), 0, None)
+            self._excess = sp.csr_matrix((data, self.log_values.indices, self.log_values.indptr),
+                                         shape=self.shape)
+        return self._excess
+
+    def log_row(self, i):
+        row = np.full(self.shape[1], self.log_floor[i])
+        start, end = self.log_values.indptr[i], self.log_values.indptr[i + 1]
+        row[self.log_values.indices[start:end]] = self.log_values.data[start:end]
+        return row
+
+    def log_columns(self, columns):
+        """
+        Returns the log probabilities of the given columns for every row as dense array (len(columns), n_rows).
+        """
+        if self._columns is None:
+            self._columns = self.log_values.tocsc()
+        result = np.repeat(self.log_floor[np.newaxis, :], len(columns), axis=0)
+        selected = self._columns[:, columns].tocoo()
+        result[selected.col, selected.row] = selected.data
+        return result
+
+    def blend(self, other, weight):
+        """
+        Returns weight * self + (1 - weight) * other, normalized with smoothing like normalize.
+        """
+        floor = self.floor() * weight + other.floor() * (1 - weight)
+        excess = (self.excess() * weight + other.excess() * (1 - weight)).tocsr()
+        values = excess.copy()
+        values.data = values.data + floor[np.repeat(np.arange(self.shape[0]), np.diff(values.indptr))]
+        return LogSparseMatrix.from_weights(floor, values)
+
+    def sample_rows(self, rows, u, random_state):
+        """
+        Returns the columns drawn from the given rows for the uniform numbers u, all rows at once.
+        The cumulative sums of the support are shifted by their row index and flattened like in
+        HiddenMarkovModel._get_cdfs, they are built once since the matrix never changes.
+        """
+        indptr = self.log_values.indptr
+        indices = self.log_values.indices
+        if self._cdf is None:
+            self.log_values.sort_indices()
+            rows_of = self._rows()
+            cumulative = np.cumsum(np.exp(self.log_values.data))
+            row_starts = np.concatenate(([0], cumulative))[indptr[:-1]]
+            self._cdf = cumulative - row_starts[rows_of] + rows_of
+            # number of floor entries left of every support entry, shifted by the row index
+            ranks = np.arange(len(rows_of)) - indptr[rows_of]
+            self._gaps = indices - ranks + rows_of * (self.shape[1] + 1)
+        rows = np.asarray(rows)
+        positions = np.maximum(np.searchsorted(self._cdf, rows + u, side='right'), indptr[rows])
+        on_support = positions < indptr[rows + 1]
+        columns = np.empty(len(rows), dtype=int)
+        columns[on_support] = indices[positions[on_support]]
+        floor_rows = rows[~on_support]
+        if len(floor_rows):
+            # one of the floor entries, all of them are equally likely
+            n_free = self.shape[1] - (indptr[floor_rows + 1] - indptr[floor_rows])
+            k = random_state.randint(np.maximum(n_free, 1))
+            before = np.searchsorted(self._gaps, floor_rows * (self.shape[1] + 1) + k, side='right')
+            floor_columns = k + before - indptr[floor_rows]
+            # a row without floor entries only gets here by rounding, take its last entry
+            full = n_free == 0
+            floor_columns[full] = indices[indptr[floor_rows[full] + 1] - 1]
+            columns[~on_support] = floor_columns
+        return columns
+
+    def dense(self):
+        return np.vstack([np.exp(self.log_row(i)) for i in range(self.shape[0])])
+
+    def get_arrays(self, name):
+        return {
+            name + '_log_floor': self.log_floor,
+            name + '_data': self.log_values.data,
+            name + '_indices': self.log_values.indices,
+            name + '_indptr': self.log_values.indptr,
+            name + '_shape': np.array(self.shape)
+        }
+
+    @classmethod
+    def from_arrays(cls, params, name):
+        log_values = sp.csr_matrix((params[name + '_data'], params[name + '_indices'], params[name + '_indptr']),
+                                   shape=tuple(params[name + '_shape']))
+        return cls(np.asarray(params[name + '_log_floor']), log_values)
+
+
+class SparseHiddenMarkovModel(HmmTraining):
+    PROBABILITIES = ('startprob', 'transmat', 'emissionprob')
+
+    def __init__(self, states, observations, init='zero', multitone=False, vice_versa=False, n_iter=1000, tol=1e-2,
+                 time_budget=None):
+        """
+        This is the constructor for a SparseHiddenMarkovModel, which has the same interface as a
+        HiddenMarkovModel, but keeps counts and probabilities sparse in log space. The smoothing of
+        zero probabilities is applied implicitly by the floor of each row instead of being materialised.
+        Only the zero and discrete initialisation are supported, the others are dense by nature.
+        """
+        if init not in ('zero', 'discrete'):
+            raise ValueError("The sparse hmm supports the zero and discrete initialisation only")
+        self.init = init
+        self.multitone = multitone
+        self.vice_versa = vice_versa
+        self.flexible = False
+        self.states = list(states)
+        self.n_states = len(self.states)
+        self.observations = list(observations)
+        self.n_observations = len(self.observations)
+        self.n_iter = n_iter
+        self.tol = tol
+        self.time_budget = time_budget
+        self.fit_report = None
+        self.random_state = None
+        self._index_symbols()
+        self._init_zeros()
+        if init == 'discrete':
+            self.normalize()
+
+    def _index_symbols(self):
+        # dicts from symbol to index, to avoid linear list searches, shared with every hmm of the vocabulary
+        self.state_index = symbol_index(tuple(self.states))
+        self.observation_index = symbol_index(tuple(self.observations))
+
+    def _init_zeros(self):
+        self.startprob = LogSparseMatrix.zeros(1, self.n_states)
+        self.transmat = LogSparseMatrix.zeros(self.n_states, self.n_states)
+        self.emissionprob = LogSparseMatrix.zeros(self.n_states, self.n_observations)
+
+    @staticmethod
+    def serialize(state, observation):
+        return SOPair(state, observation)
+
+    def training_copy(self):
+        # the matrices are never changed, training replaces them
+        hmm = copy.copy(self)
+        hmm.states = list(self.states)
+        hmm.observations = list(self.observations)
+        return hmm
+
+    def get_parameters(self):
+        params = {'states': self.states, 'observations': self.observations}
+        params.update(self.startprob.get_arrays('startprob'))
+        params.update(self.transmat.get_arrays('transmat'))
+        params.update(self.emissionprob.get_arrays('emissionprob'))
+        return params
+
+    def set_parameters(self, params):
+        self.states = list(params['states'])
+        self.n_states = len(self.states)
+        self.observations = list(params['observations'])
+        self.n_observations = len(self.observations)
+        self.startprob = LogSparseMatrix.from_arrays(params, 'startprob')
+        self.transmat = LogSparseMatrix.from_arrays(params, 'transmat')
+        self.emissionprob = LogSparseMatrix.from_arrays(params, 'emissionprob')
+        self._index_symbols()
+
+    def to_dense(self):
+        # materialised probabilities, for comparison with a HiddenMarkovModel
+        return self.startprob.dense()[0], self.transmat.dense(), self.emissionprob.dense()
+
+    def index_so_pairs(self, so_pairs):
+        return np.stack(self.get_index_vectors(so_pairs), axis=1)
+
+    def train(self, so_pairs, diy=False, weight=50, pretrain=True):
+        state_indices, observation_indices = self.get_index_vectors(so_pairs)
+        self.train_indices(state_indices, observation_indices, diy, weight, pretrain)
+
+    def _fit_window(self, state_indices, observation_indices, diy, pretrain):
+        # the new probabilities of train_indices, before they are blended with the old ones
+        if diy:
+            self.fit_indices(state_indices, observation_indices, smoothing=False)
+        else:
+            if self.init == 'zero' and not pretrain:
+                self.fit_indices(state_indices, observation_indices)
+            self.fit_budgeted(observation_indices)
+
+    def _start_counts(self):
+        # train_chunks sums the sparse counts of the chunks, only they are kept
+        return self.count_indices(np.zeros(0, dtype=int), np.zeros(0, dtype=int))
+
+    def _add_counts(self, counts, state_indices, observation_indices):
+        return [total + chunk for total, chunk in zip(counts, self.count_indices(state_indices, observation_indices))]
+
+    def _finish_counts(self, counts, old_probabilities):
+        self._set_counts(*counts, smoothing=False)
+        return old_probabilities
+
+    @staticmethod
+    def _blend_matrix(new, old, weight):
+        return new.blend(old, weight)
+
+    def fit_indices(self, state_indices, observation_indices, smoothing=True):
+        """
+        Counts the starts, emissions and transitions of every state-observation pair with a successor
+        like HiddenMarkovModel.fit_indices, but into sparse matrices, and normalizes them.
+        """
+        self._set_counts(*self.count_indices(state_indices, observation_indices), smoothing=smoothing)
+
+    def count_indices(self, state_indices, observation_indices):
+        # sparse counts of the starts, transitions and emissions, duplicates are summed
+        prev_states = state_indices[:-1]
+        ones = np.ones(len(prev_states))
+        starts = sp.csr_matrix((ones, (np.zeros(len(prev_states), dtype=int), prev_states)), shape=(1, self.n_states))
+        transitions = sp.csr_matrix((ones, (prev_states, state_indices[1:])), shape=(self.n_states, self.n_states))
+        emissions = sp.csr_matrix((ones, (prev_states, observation_indices[:-1])),
+                                  shape=(self.n_states, self.n_observations))
+        return starts, transitions, emissions
+
+    def _set_counts(self, starts, transitions, emissions, smoothing=True):
+        self.startprob = LogSparseMatrix.from_weights(np.zeros(1), starts, smoothing)
+        self.transmat = LogSparseMatrix.from_weights(np.zeros(self.n_states), transitions, smoothing)
+        self.emissionprob = LogSparseMatrix.from_weights(np.zeros(self.n_states), emissions, smoothing)
+
+    def normalize(self):
+        self.startprob = LogSparseMatrix.from_weights(self.startprob.floor(), self._linear(self.startprob))
+        self.transmat = LogSparseMatrix.from_weights(self.transmat.floor(), self._linear(self.transmat))
+        self.emissionprob = LogSparseMatrix.from_weights(self.emissionprob.floor(), self._linear(self.emissionprob))
+
+    @staticmethod
+    def _linear(matrix):
+        values = matrix.log_values.copy()
+        values.data = np.exp(values.data)
+        return values
+
+    def _forward(self, log_emissions):
+        """
+        Returns the forward lattice in log space. Every step is rescaled by its maximum,
+        so the transition can be applied as sparse product plus the floor of each row.
+        """
+        floor = self.transmat.floor()
+        excess_t = self.transmat.excess().T.tocsr()
+        log_alpha = np.empty_like(log_emissions)
+        log_alpha[0] = self.startprob.log_row(0) + log_emissions[0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for t in range(1, len(log_emissions)):
+                shift = np.max(log_alpha[t - 1])
+                alpha = np.exp(log_alpha[t - 1] - shift)
+                log_alpha[t] = np.log(np.clip(alpha @ floor + excess_t @ alpha, 0, None)) + shift + log_emissions[t]
+        return log_alpha
+
+    def _backward(self, log_emissions):
+        floor = self.transmat.floor()
+        excess = self.transmat.excess()
+        log_beta = np.zeros_like(log_emissions)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for t in range(len(log_emissions) - 2, -1, -1):
+                log_next = log_beta[t + 1] + log_emissions[t + 1]
+                shift = np.max(log_next)
+                beta = np.exp(log_next - shift)
+                log_beta[t] = np.log(floor * beta.sum() + excess @ beta) + shift
+        return log_beta
+
+    def score(self, observation_indices):
+        """
+        Returns the log likelihood of a sequence of observation indices.
+        """
+        log_emissions = self.emissionprob.log_columns(observation_indices)
+        return logsumexp(self._forward(log_emissions)[-1])
+
+    def _start_fit(self, observation_indices):
+        # Baum-Welch runs on the observation indices, expected emissions are only counted for the
+        # observed symbols, so the emission matrix stays sparse
+        return observation_indices
+
+    def _em_step(self, observation_indices):
+        n_samples = len(observation_indices)
+        log_emissions = self.emissionprob.log_columns(observation_indices)
+        log_alpha = self._forward(log_emissions)
+        log_beta = self._backward(log_emissions)
+        logprob = logsumexp(log_alpha[-1])
+        with np.errstate(invalid='ignore'):
+            posteriors = np.exp(log_alpha + log_beta - logprob)
+        posteriors = np.nan_to_num(posteriors)
+        # expected transitions on the support
+        support = self.transmat.log_values.tocoo()
+        log_next = log_emissions[1:] + log_beta[1:]
+        with np.errstate(invalid='ignore'):
+            log_xi = log_alpha[:-1][:, support.row] + support.data + log_next[:, support.col] - logprob
+            transitions = np.exp(logsumexp(log_xi, axis=0)) if n_samples > 1 else np.zeros(len(support.data))
+        transitions = sp.csr_matrix((np.nan_to_num(transitions), (support.row, support.col)),
+                                    shape=self.transmat.shape)
+        # expected transitions into the floor entries, the transition matrix has only n_states x n_states
+        # entries, so they are computed for all of them to keep the result exact
+        if n_samples > 1:
+            pattern = self.transmat.log_values.copy()
+            pattern.data = np.ones(len(pattern.data))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                shift = np.max(log_next, axis=1)
+                beta = np.nan_to_num(np.exp(log_next - shift[:, np.newaxis]))
+                weights = np.nan_to_num(np.exp(log_alpha[:-1] + self.transmat.log_floor + shift[:, np.newaxis]
+                                               - logprob))
+            floor_transitions = (weights.T @ beta) * (1 - pattern.toarray())
+            transitions = transitions + sp.csr_matrix(floor_transitions)
+        # expected emissions of the observed symbols
+        emissions = sp.csr_matrix((posteriors.T.ravel(), (np.repeat(np.arange(self.n_states), n_samples),
+                                                          np.tile(observation_indices, self.n_states))),
+                                  shape=self.emissionprob.shape)
+        starts = sp.csr_matrix(posteriors[0][np.newaxis, :])
+        self.startprob = LogSparseMatrix.from_weights(np.zeros(1), starts, smoothing=False)
+        self.transmat = LogSparseMatrix.from_weights(np.zeros(self.n_states), transitions, smoothing=False)
+        self.emissionprob = LogSparseMatrix.from_weights(np.zeros(self.n_states), emissions, smoothing=False)
+        return logprob
+
+    def viterbi(self, observation_indices):
+        """
+        Returns the log probability and the state indices of the most likely state sequence.
+        For every state the best predecessor is either an entry of the support or the best floor entry.
+        """
+        log_emissions = self.emissionprob.log_columns(observation_indices)
+        columns = self.transmat.log_values.tocsc()
+        column_of_entry = np.repeat(np.arange(self.n_states), np.diff(columns.indptr))
+        n_samples = len(observation_indices)
+        delta = self.startprob.log_row(0) + log_emissions[0]
+        backpointers = np.zeros((n_samples, self.n_states), dtype=int)
+        for t in range(1, n_samples):
+            floor_candidates = delta + self.transmat.log_floor
+            best_floor = np.argmax(floor_candidates)
+            best = np.full(self.n_states, floor_candidates[best_floor])
+            pointer = np.full(self.n_states, best_floor)
+            if len(columns.data):
+                candidates = delta[columns.indices] + columns.data
+                order = np.lexsort((-candidates, column_of_entry))
+                first = np.r_[True, column_of_entry[order][1:] != column_of_entry[order][:-1]]
+                top = order[first]
+                better = candidates[top] > best[column_of_entry[top]]
+                best[column_of_entry[top][better]] = candidates[top][better]
+                pointer[column_of_entry[top][better]] = columns.indices[top][better]
+            delta = best + log_emissions[t]
+            backpointers[t] = pointer
+        state_indices = np.empty(n_samples, dtype=int)
+        state_indices[-1] = np.argmax(delta)
+        for t in range(n_samples - 1, 0, -1):
+            state_indices[t - 1] = backpointers[t][state_indices[t]]
+        return delta[state_indices[-1]], state_indices
+
+    def sample_indices(self, nr_samples, nr_sequences=1, random_state=None):
+        """
+        Draws nr_sequences sequences of nr_samples states and observations like
+        HiddenMarkovModel.sample_indices and returns their indices as arrays (nr_sequences, nr_samples).
+        """
+        random_state = check_random_state(random_state if random_state is not None else self.random_state)
+        uniforms = random_state.rand(nr_sequences, nr_samples, 2)
+        state_indices = np.empty((nr_sequences, nr_samples), dtype=int)
+        state_indices[:, 0] = self.startprob.sample_rows(np.zeros(nr_sequences, dtype=int), uniforms[:, 0, 0],
+                                                         random_state)
+        for t in range(1, nr_samples):
+            state_indices[:, t] = self.transmat.sample_rows(state_indices[:, t - 1], uniforms[:, t, 0], random_state)
+        observation_indices = self.emissionprob.sample_rows(state_indices.ravel(), uniforms[:, :, 1].ravel(),
+                                                            random_state).reshape(nr_sequences, nr_samples)
+        return state_indices, observation_indices
+
+    def get_sample_so_pairs(self, nr_samples):
+        return self.get_sample_so_pairs_batch(nr_samples, 1)[0]
+
+    @metrics.timed('hmm_sample')
+    def get_sample_so_pairs_batch(self, nr_samples, nr_sequences):
+        if nr_samples < 1:
+            return [[] for _ in range(nr_sequences)]
+        state_indices, observation_indices = self.sample_indices(nr_samples, nr_sequences)
+        return [[self.serialize(self.states[s], self.observations[o]) for s, o in zip(states, observations)]
+                for states, observations in zip(state_indices.tolist(), observation_indices.tolist())]
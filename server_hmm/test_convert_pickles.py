@@ -0,0 +1,84 @@
+#!/usr/bin/python
+# This class handles the tests of convert_pickles.py, no pickle may call code outside of a saved hmm.
+
+import io
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import convert_pickles
+
+# callables a crafted pickle could call, the first argument is a command which creates the marker file
+CALLABLES = [
+    ('os', 'system'),
+    ('posix', 'system'),
+    ('subprocess', 'call'),
+    ('builtins', 'eval'),
+    ('builtins', 'exec'),
+    ('builtins', 'getattr'),
+    ('numpy.testing._private.utils', 'runstring'),
+    ('numpy', 'load'),
+    ('hmmlearn.base', '_AbstractHMM'),
+    ('sklearn.utils', 'check_random_state'),
+    ('hmm_handler', 'pretty_midi'),
+    ('my_hmm', 'np'),
+    ('parser', 'os'),
+]
+
+
+def crafted_pickle(module, name, argument):
+    """
+    Returns a pickle which calls module.name(argument) while it is read.
+    """
+    return b'c' + module.encode() + b'\n' + name.encode() + b'\n(' + pickle.dumps(argument, 0)[:-1] + b'tR.'
+
+
+class ConvertPicklesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.marker = os.path.join(self.directory, 'called')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_refuses_other_callables(self):
+        for module, name in CALLABLES:
+            data = crafted_pickle(module, name, "open('" + self.marker + "', 'w').close()")
+            with self.subTest(callable=module + '.' + name):
+                with self.assertRaises(pickle.UnpicklingError):
+                    convert_pickles.HandlerUnpickler(io.BytesIO(data)).load()
+                self.assertFalse(os.path.exists(self.marker))
+
+    def test_convert_skips_crafted_pickles(self):
+        source = os.path.join(self.directory, 'pickle')
+        target = os.path.join(self.directory, 'saved')
+        os.makedirs(source)
+        with open(os.path.join(source, 'evil.pkl'), 'wb') as file:
+            file.write(crafted_pickle('numpy.testing._private.utils', 'runstring',
+                                      "open('" + self.marker + "', 'w').close()"))
+        self.assertEqual(convert_pickles.convert(source, target), [])
+        self.assertFalse(os.path.exists(self.marker))
+        self.assertFalse(os.path.exists(os.path.join(target, 'evil.hmm')))
+
+    def test_reads_arrays(self):
+        arrays = {'transmat': np.random.rand(4, 4), 'notes': np.arange(5, dtype=np.int16), 'scale': np.float64(0.5)}
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            with self.subTest(protocol=protocol):
+                loaded = convert_pickles.HandlerUnpickler(io.BytesIO(pickle.dumps(arrays, protocol))).load()
+                for key, value in arrays.items():
+                    np.testing.assert_array_equal(loaded[key], value)
+
+    def test_skips_unread_objects(self):
+        data = pickle.dumps({'random_state': np.random.RandomState(1)})
+        self.assertIsInstance(convert_pickles.HandlerUnpickler(io.BytesIO(data)).load()['random_state'],
+                              convert_pickles.Skipped)
+
+
+if __name__ == '__main__':
+    # python -m unittest test_convert_pickles
+    unittest.main()
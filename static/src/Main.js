@@ -73,7 +73,7 @@ if (USE_WEBSOCKETS) {
 		ai.sendUI(message, json)
 	})
 
-	ai.on('setHmmList', (args) => {
+	ai.on('hmmList', (args) => {
 	    ui.setHmmList(args)
     })
 
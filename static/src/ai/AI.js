@@ -34,19 +34,26 @@ class AI extends events.EventEmitter {
     }
 
     _connectToServer() {
-        this._socket = io(WEBSOCKETS_API);
+        // the token lets the server recover the session after a reconnect, also on another worker
+        this._socket = io(WEBSOCKETS_API, {
+            query: {token: localStorage.getItem('hmmSessionToken') || ''}
+        });
         /*this._socket = io(WEBSOCKETS_API, {
             path: "/spiriosessions-hmm/socket.io"
         });*/
         this._socket.on('connect', function () {
             console.log('CONNECTED');
         });
+        this._socket.on('sessionToken', token => {
+            localStorage.setItem('hmmSessionToken', token)
+            this._socket.io.opts.query = {token: token}
+        });
     }
 
     _setupPrediction() {
         this._socket.on('predicted-melody', args => this.play(args));
         this._socket.on('predicted-drums', args => this.play(args));
-        this._socket.on('setHmmList', args => this.emit('setHmmList', args));
+        this._socket.on('hmmList', args => this.emit('hmmList', args));
         this._socket.on('updateHmmList', args => this.emit('updateHmmList', args));
         this._socket.on('uiConfig', args => this.emit('uiConfig', args));
         this._socket.on('msg', args => console.log(args));
@@ -3,7 +3,7 @@ import 'style/ui.css'
 import 'style/tooltip.css'
 
 const TIPS = {
-    hmm_type: 'Create new HMM or choose saved HMM',
+    hmm_type: 'Create new HMM or choose saved HMM, the search finds saved HMMs by a part of their name',
     topology: 'Parameters affecting the HMM structure',
     init: 'Initialization type for the transition and emission probabilities',
     note: 'Note assignment <br> •	Midikeys - (88 keys from 21-109) whole keyboard range, octave information included <br> •	Semitones - (12 tones from C-H) one octave, octave change depended on input <br> •	Intervals - (25 intervals from -12-12) two octaves, learns key distances in note changes',
@@ -54,8 +54,28 @@ class UI extends events.EventEmitter {
             this.emit('send', 'changeHMM', event.target.value)
 		})
         var label = this.createLabel('hmmType', 'HMM-Type: ', TIPS.hmm_type)
+        // the server sends the saved hmms a page at a time, see setHmmList
+        this._hmmCount = 0
+        this._searchTimeout = -1
+        var search = document.createElement('input')
+        search.type = 'text'
+        search.id = 'hmmSearch'
+        search.placeholder = 'Search'
+        search.addEventListener('input', () => {
+            clearTimeout(this._searchTimeout)
+            this._searchTimeout = setTimeout(() => this.queryHmmList(0), 300)
+		})
+        var more = document.createElement('BUTTON')
+        more.id = 'hmmMore'
+        more.textContent = 'More'
+        more.style.display = 'none'
+        more.addEventListener('click', () => {
+            this.queryHmmList(this._hmmCount)
+		})
         hmmType.appendChild(label)
         hmmType.appendChild(select)
+        hmmType.appendChild(search)
+        hmmType.appendChild(more)
 		// var hmms = ['new']
 		// var hmmSelect = this.createSelectLabelCombi('hmmType', hmms, 'HMM-Type: ')
         // TOPOLOGY
@@ -106,18 +126,28 @@ class UI extends events.EventEmitter {
 		return uiDiv
     }
 
-	setHmmList(list){
+	setHmmList(page){
+	    // a page {total, offset, models} of the saved hmms, the first page replaces the list, the next ones are appended
 	    var hmmSelect = document.getElementById('hmmType')
-	    var length = hmmSelect.options.length;
-        for (var i = length-1; i >= 1; i--) {
-            hmmSelect.remove(i)
+	    if (page.offset === 0) {
+            var length = hmmSelect.options.length;
+            for (var i = length-1; i >= 1; i--) {
+                hmmSelect.remove(i)
+            }
         }
-	    for (const val of list) {
+	    for (const model of page.models) {
             var option = document.createElement('option');
-            option.value = val;
-            option.text = val.charAt(0).toUpperCase() + val.slice(1);
+            option.value = model.name;
+            option.text = model.name.charAt(0).toUpperCase() + model.name.slice(1);
             hmmSelect.appendChild(option);
         }
+        this._hmmCount = page.offset + page.models.length
+        document.getElementById('hmmMore').style.display = this._hmmCount < page.total ? 'inline-block' : 'none'
+	}
+
+	queryHmmList(offset){
+	    var search = document.getElementById('hmmSearch').value
+	    this.emit('send', 'queryHmmList', JSON.stringify({offset: offset, search: search}))
 	}
 
 	updateHmmList(val){
@@ -127,6 +157,8 @@ class UI extends events.EventEmitter {
         option.text = val.charAt(0).toUpperCase() + val.slice(1);
         hmmSelect.appendChild(option);
         hmmSelect.value = val;
+        // the new hmm is the newest, the next page starts one later
+        this._hmmCount += 1
 	}
 
 	setConfig(json){
@@ -193,6 +225,10 @@ class UI extends events.EventEmitter {
                 jsonObject = {};
         for(var i = 0; i < inputElements.length; i++){
             var inputElement = inputElements[i];
+            // the search of the saved hmms is not part of the config
+            if (!inputElement.name) {
+                continue
+            }
             if (inputElement.checked || inputElement.type != 'radio'){
                 // if (inputElement.id == 'files') {
                     // console.log(inputElement.value)